@@ -3,11 +3,25 @@
 import requests
 import uuid
 import json
-from flask import Flask, request, jsonify, render_template
+import hashlib
+from datetime import datetime
+from flask import Flask, request, jsonify, render_template, g, has_request_context, Response
 import sqlite3
 import os
 import time
+import threading
+import atexit
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+import bisect
+import unicodedata
+import heapq
+import itertools
 import pandas as pd # Zum Lesen von Excel-Dateien
+import numpy as np # Kommt mit pandas mit
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -26,6 +40,11 @@ DATABASE_FILENAME = 'drug.db'
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_PATH = os.path.join(BASE_DIR, DATABASE_FILENAME)
 EXTERNAL_CDS_HOOK_URL = "http://cql-sandbox.projekte.fh-hagenberg.at:8080/cds-services/EngpassMed"
+CDS_HOOK_TIMEOUT_SECONDS = 20
+CDS_HOOK_POOL_SIZE = 4 # Keep-Alive-Verbindungen und parallele Hintergrund-Aufrufe
+CDS_BREAKER_FAILURE_THRESHOLD = 3 # Nach so vielen Fehlern in Folge wird nicht mehr gesendet ...
+CDS_BREAKER_RESET_SECONDS = 30 # ... bis diese Zeit um ist (dann ein Probeaufruf)
+CDS_HOOK_RESULT_HISTORY = 500 # So viele Ergebnisse von Hintergrund-Aufrufen bleiben abrufbar
 
 # --- Konfiguration für Download & DB Update ---
 BASG_PAGE_URL = "https://medicineshortage.basg.gv.at/vertriebseinschraenkungen/faces/adf.task-flow?_document=WEB-INF%2Fmain-btf.xml&_id=main-btf"
@@ -34,128 +53,973 @@ DOWNLOAD_DIR = BASE_DIR
 EXPECTED_DOWNLOAD_FILENAME = "Vertriebseinschraenkungen.xlsx"
 DOWNLOAD_FILE_PATH = os.path.join(DOWNLOAD_DIR, EXPECTED_DOWNLOAD_FILENAME)
 SELENIUM_TIMEOUT_SECONDS = 45
-DOWNLOAD_WAIT_SECONDS = 30
+DOWNLOAD_WAIT_SECONDS = 30 # Maximale Wartezeit auf den Download (Deadline, kein fixer Sleep mehr)
+DOWNLOAD_POLL_INTERVAL_SECONDS = 0.5
+DOWNLOAD_STABLE_CHECKS = 1 # So oft muss die Dateigröße hintereinander gleich bleiben
+WEBDRIVER_KEEP_WARM = True # Browser zwischen Updates offen halten statt jedes Mal neu zu starten
+WEBDRIVER_MAX_USES = 20 # Danach wird der warme Browser ersetzt (Speicherlecks, Sitzungsreste)
 
+# --- Konfiguration der SQLite-Verbindungen ---
+DB_JOURNAL_MODE = "WAL" # Leser und der Import-Schreiber blockieren sich nicht gegenseitig
+DB_SYNCHRONOUS = "NORMAL" # Mit WAL sicher gegen Korruption, spart ein fsync pro Commit
+DB_BUSY_TIMEOUT_SECONDS = 10 # So lange auf Sperren warten statt sofort "database is locked"
+DB_MMAP_SIZE_BYTES = 256 * 1024 * 1024
+DB_CACHE_SIZE_KIB = 64 * 1024 # Page-Cache je Verbindung
+DRUG_INDEX_STALE_CHECK_SECONDS = 30 # So oft prüft eine Anfrage, ob asp seit dem Aufbau des Drug-Index geändert wurde
 
-# --- Datenbankfunktionen ---
-def get_db():
-    """ Stellt eine Verbindung zur SQLite-Datenbank her. """
+
+# --- Latenz-Metriken (Prometheus-Textformat unter /metrics) ---
+METRICS_PREFIX = "atc_altfinder"
+METRICS_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120) # Sekunden
+
+class LatencyHistogram:
+    """ Histogramm mit festen Bucket-Grenzen (obere Grenzen inklusive, wie 'le' bei Prometheus). """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # letzter Eintrag: +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    Sammelt Latenz-Histogramme und Zähler prozessweit. Ein Eintrag kostet ein
+    Lock und eine Binärsuche über die Bucket-Grenzen, das reicht für den Dauerbetrieb.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.histograms = {} # (Metrik, Labels) -> LatencyHistogram
+        self.counters = {} # (Metrik, Labels) -> Wert
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def observe(self, metric, seconds, labels=(), help_text=""):
+        with self.lock:
+            histogram = self.histograms.get((metric, labels))
+            if histogram is None:
+                histogram = self.histograms[(metric, labels)] = LatencyHistogram(self.buckets)
+                self.help.setdefault(metric, help_text)
+            histogram.observe(seconds)
+
+    def increment(self, metric, labels=(), amount=1, help_text=""):
+        with self.lock:
+            self.counters[(metric, labels)] = self.counters.get((metric, labels), 0) + amount
+            self.help.setdefault(metric, help_text)
+
+    def render(self):
+        """ Alle Metriken im Prometheus-Textformat (Version 0.0.4). """
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        format_labels = lambda labels: ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+        lines = []
+        with self.lock:
+            for metric in sorted({metric for metric, _ in self.histograms}):
+                lines += [f"# HELP {metric} {self.help.get(metric, '')}", f"# TYPE {metric} histogram"]
+                for (name, labels), histogram in sorted(self.histograms.items()):
+                    if name != metric: continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{format_labels(labels + (("le", bound),))}}} {cumulative}')
+                    lines.append(f"{metric}_sum{{{format_labels(labels)}}} {histogram.sum:.6f}")
+                    lines.append(f"{metric}_count{{{format_labels(labels)}}} {histogram.count}")
+            for metric in sorted({metric for metric, _ in self.counters}):
+                lines += [f"# HELP {metric} {self.help.get(metric, '')}", f"# TYPE {metric} counter"]
+                for (name, labels), value in sorted(self.counters.items()):
+                    if name == metric: lines.append(f"{metric}{{{format_labels(labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+
+def record_timing(operation, seconds, failed=False):
+    """
+    Verbucht eine gemessene Dauer im Histogramm der Operation und - innerhalb
+    einer Flask-Anfrage - in deren Zeitaufschlüsselung (g.timings).
+    """
+    metrics.observe(f"{METRICS_PREFIX}_operation_duration_seconds", seconds, (("operation", operation),),
+                    "Dauer einzelner Operationen (DB, Suche, CDS Hook, Download, Import)")
+    if failed:
+        metrics.increment(f"{METRICS_PREFIX}_operation_errors_total", (("operation", operation),),
+                          help_text="Operationen, die mit einer Exception abgebrochen sind")
+    if has_request_context():
+        timings = getattr(g, "timings", None)
+        if timings is not None:
+            entry = timings.setdefault(operation, [0, 0.0])
+            entry[0] += 1; entry[1] += seconds
+
+def timed(operation):
+    """ Decorator: misst jede Ausführung der Funktion als `operation`. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter(); failed = True
+            try:
+                result = func(*args, **kwargs); failed = False
+                return result
+            finally:
+                record_timing(operation, time.perf_counter() - start, failed)
+        return wrapper
+    return decorator
+
+@contextlib.contextmanager
+def timing(operation):
+    """ Wie @timed, aber für einen Codeblock. """
+    start = time.perf_counter(); failed = True
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        yield; failed = False
+    finally:
+        record_timing(operation, time.perf_counter() - start, failed)
+
+def wants_debug_timings():
+    """ Zeitaufschlüsselung angefordert? Per ?debug_timings=1 oder "debug_timings": true im JSON Body. """
+    if request.args.get("debug_timings", "").lower() in ("1", "true", "yes"): return True
+    body = request.get_json(silent=True)
+    return isinstance(body, dict) and bool(body.get("debug_timings"))
+
+def timings_breakdown():
+    """ Zeitaufschlüsselung der laufenden Anfrage (verschachtelte Aufrufe sind in der äußeren Zeit enthalten). """
+    breakdown = {operation: {"calls": calls, "ms": round(seconds * 1000, 3)} for operation, (calls, seconds) in getattr(g, "timings", {}).items()}
+    return {"total_ms": round((time.perf_counter() - g.request_started) * 1000, 3), "operations": breakdown}
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.timings = {}
+
+@app.after_request
+def record_request_timing(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "<unbekannt>"
+        metrics.observe(f"{METRICS_PREFIX}_http_request_duration_seconds", time.perf_counter() - started,
+                        (("endpoint", endpoint), ("method", request.method)), "Dauer der HTTP-Anfragen je Endpunkt")
+        metrics.increment(f"{METRICS_PREFIX}_http_requests_total", (("endpoint", endpoint), ("method", request.method), ("status", response.status_code)),
+                          help_text="HTTP-Anfragen je Endpunkt und Statuscode")
+    return response
+
+
+# --- Datenbankfunktionen ---
+class ConnectionPool:
+    """
+    Verbindungen zu einer DB-Datei: je Thread eine wiederverwendbare
+    Lese-Verbindung (Autocommit, mehrteilige Lesevorgänge mit BEGIN klammern)
+    und genau eine Schreib-Verbindung, die exklusiv vergeben wird.
+    Im WAL-Modus lesen Leser während eines Imports ungestört den letzten Commit.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.write_lock = threading.RLock() # reentrant: Import -> refresh_drug_index im selben Thread
+        self.write_depth = 0
+        self.writer_conn = self.connect()
+        self.journal_mode = self.writer_conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}").fetchone()[0]
+        if self.journal_mode.upper() != DB_JOURNAL_MODE.upper():
+            print(f"WARNUNG: journal_mode {DB_JOURNAL_MODE} nicht verfügbar, verwende {self.journal_mode}.")
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE_BYTES)}")
+        conn.execute(f"PRAGMA cache_size = -{int(DB_CACHE_SIZE_KIB)}") # negativ: Angabe in KiB statt Seiten
+        return conn
+
+    def reader(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            conn.isolation_level = None
         return conn
+
+    def acquire_writer(self):
+        self.write_lock.acquire()
+        self.write_depth += 1
+        return self.writer_conn
+
+    def release_writer(self):
+        self.write_depth -= 1
+        try:
+            if self.write_depth == 0 and self.writer_conn.in_transaction:
+                print("WARNUNG: Offene Schreibtransaktion bei Rückgabe der Verbindung, Rollback.")
+                self.writer_conn.rollback()
+        finally:
+            self.write_lock.release()
+
+    def close(self):
+        with self.write_lock:
+            self.writer_conn.close()
+
+_db_pools = {} # Pfad -> ConnectionPool (DATABASE_PATH kann zur Laufzeit umgestellt werden, z.B. im Benchmark)
+_db_pools_lock = threading.Lock()
+
+def get_db_pool():
+    pool = _db_pools.get(DATABASE_PATH)
+    if pool is None:
+        with _db_pools_lock:
+            pool = _db_pools.get(DATABASE_PATH)
+            if pool is None:
+                pool = _db_pools[DATABASE_PATH] = ConnectionPool(DATABASE_PATH)
+    return pool
+
+@atexit.register
+def close_db_pools():
+    for pool in list(_db_pools.values()):
+        try: pool.close()
+        except sqlite3.Error: pass
+
+@timed("get_db")
+def get_db():
+    """
+    Liefert die Lese-Verbindung dieses Threads zur SQLite-Datenbank (wird
+    wiederverwendet, daher nicht schließen). Rückgabe: Verbindung oder None bei Fehler.
+    """
+    try:
+        return get_db_pool().reader()
     except sqlite3.Error as e:
         print(f"!!! Datenbankfehler beim Verbinden: {e}")
         print(f"    Versuchter Pfad: {DATABASE_PATH}")
         return None
 
-def check_shortage(name):
+@timed("get_write_db")
+def get_write_db():
     """
-    Prüft, ob ein Medikamenten-NAME *überhaupt* in der shortage-Tabelle vorkommt,
-    IGNORIERT dabei den Status.
-    Rückgabe: True wenn Name gefunden, False sonst, None bei DB-Fehler.
+    Holt die (einzige) Schreib-Verbindung und wartet, bis sie frei ist.
+    Muss mit release_write_db() zurückgegeben werden. Rückgabe: Verbindung oder None bei Fehler.
     """
-    # Eingabevalidierung
-    if not name:
-        print("Warnung: check_shortage ohne Namen aufgerufen.")
-        return False # Kein Name, kein Eintrag
+    try:
+        return get_db_pool().acquire_writer()
+    except sqlite3.Error as e:
+        print(f"!!! Datenbankfehler beim Verbinden (Schreiben): {e}")
+        print(f"    Versuchter Pfad: {DATABASE_PATH}")
+        return None
 
-    conn = get_db()
-    if not conn:
-        print("FEHLER: check_shortage konnte keine DB-Verbindung herstellen.")
-        return None # DB-Fehler signalisieren
+def release_write_db():
+    get_db_pool().release_writer()
+
+# --- Schema-Migrationen (Version steht in PRAGMA user_version) ---
+SHORTAGE_DATE_FORMATS = ("%d.%m.%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d.%m.%Y %H:%M:%S", "%d.%m.%y")
+
+def parse_shortage_date(text):
+    """ Wandelt ein Datum aus dem BASG-Export in 'YYYY-MM-DD' um (None, wenn nicht lesbar). """
+    if not text: return None
+    text = str(text).strip()
+    for date_format in SHORTAGE_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def normalize_shortage_status(status):
+    """ Status ohne Leerzeichen-Varianten in Großbuchstaben (z.B. ' aktiv ' -> 'AKTIV'). """
+    normalized = " ".join(str(status or "").split()).upper()
+    return normalized or "UNBEKANNT"
+
+def table_columns(cur, table):
+    """ Spaltennamen einer Tabelle laut PRAGMA table_info. """
+    return [row[1] for row in cur.execute(f'PRAGMA table_info("{table}")')]
 
-    is_present = False # Bedeutet jetzt: Name ist in der Tabelle vorhanden?
+def fill_shortage_derived_columns(cur):
+    """
+    Berechnet status_normalized, datum_meldung_iso und datum_aenderung_iso für
+    alle Zeilen, bei denen sie noch fehlen (neu eingefügt oder geändert).
+    Läuft in der Transaktion des Aufrufers. Rückgabe: Anzahl aktualisierter Zeilen.
+    """
+    rows = cur.execute("""
+        SELECT rowid, Status, "Datum der Meldung", "Datum der letzten Änderung"
+        FROM shortage WHERE status_normalized IS NULL""").fetchall()
+    cur.executemany("""
+        UPDATE shortage SET status_normalized = ?, datum_meldung_iso = ?, datum_aenderung_iso = ?
+        WHERE rowid = ?""",
+        [(normalize_shortage_status(status), parse_shortage_date(reported), parse_shortage_date(changed), rowid)
+         for rowid, status, reported, changed in rows])
+    return len(rows)
+
+def migration_add_lookup_indexes(cur):
+    """ Indizes für die Namens-, ATC- und Engpass-Abfragen. """
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_asp_name ON asp (Name)")
+    # NOCASE: damit sind die Präfix-Abfragen 'Name LIKE ?' und 'ATC_Code LIKE ?' indexfähig
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_asp_name_nocase ON asp (Name COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_asp_atc_code ON asp (ATC_Code COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_shortage_name ON shortage (Name)")
+
+def migration_add_shortage_derived_columns(cur):
+    """ Normalisierter Status und ISO-Datumsspalten in shortage. """
+    existing = table_columns(cur, "shortage")
+    for column in ("status_normalized", "datum_meldung_iso", "datum_aenderung_iso"):
+        if column not in existing:
+            cur.execute(f"ALTER TABLE shortage ADD COLUMN {column} TEXT")
+    fill_shortage_derived_columns(cur)
+
+SHORTAGE_INACTIVE_STATUSES = {"BEENDET"} # Normalisierte Status-Werte, die keinen aktiven Engpass mehr bedeuten
+
+def deciding_shortage_reports(cur):
+    """
+    Liefert pro Name die maßgebliche Meldung als Zeilen (Name, Status,
+    status_normalized, datum_meldung_iso, datum_aenderung_iso): die jüngste
+    noch offene Meldung, falls es eine gibt, sonst die jüngste beendete.
+    Ein Medikament kann mehrere Meldungen (z.B. je Packung) haben; eine
+    beendete Meldung hebt eine andere, noch offene nicht auf.
+    """
+    inactive = sorted(SHORTAGE_INACTIVE_STATUSES)
+    placeholders = ", ".join("?" * len(inactive)) or "NULL"
+    return cur.execute(f"""
+        SELECT Name, Status, status_normalized, datum_meldung_iso, datum_aenderung_iso FROM (
+            SELECT Name, Status, status_normalized, datum_meldung_iso, datum_aenderung_iso,
+                   ROW_NUMBER() OVER (PARTITION BY Name
+                                      ORDER BY COALESCE(status_normalized NOT IN ({placeholders}), 1) DESC,
+                                               datum_meldung_iso DESC, datum_aenderung_iso DESC, Status) AS report_rank
+            FROM shortage WHERE Name IS NOT NULL AND Name != ''
+        ) WHERE report_rank = 1""", inactive).fetchall()
+
+def rebuild_active_shortage(cur):
+    """
+    Baut die Tabelle active_shortage neu auf: ein Eintrag je Name, von dem
+    mindestens eine Meldung keinen Status aus SHORTAGE_INACTIVE_STATUSES hat.
+    Läuft in der Transaktion des Aufrufers.
+    Rückgabe: (Zeilen je normalisiertem Status, Anzahl aktiver Engpässe).
+    """
+    active_rows = [row for row in deciding_shortage_reports(cur) if row[2] not in SHORTAGE_INACTIVE_STATUSES]
+    cur.execute("DELETE FROM active_shortage")
+    cur.executemany("""
+        INSERT INTO active_shortage (Name, Status, status_normalized, datum_meldung_iso, datum_aenderung_iso)
+        VALUES (?, ?, ?, ?, ?)""", active_rows)
+    status_buckets = dict(cur.execute("SELECT status_normalized, COUNT(*) FROM shortage GROUP BY status_normalized ORDER BY 2 DESC").fetchall())
+    return status_buckets, len(active_rows)
+
+def migration_add_active_shortage(cur):
+    """ Materialisierte Liste der aktiven Engpässe (ein Eintrag je Name). """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS active_shortage (
+            Name TEXT PRIMARY KEY,
+            Status TEXT, -- Status laut BASG, wie in shortage
+            status_normalized TEXT,
+            datum_meldung_iso TEXT,
+            datum_aenderung_iso TEXT
+        )""")
+    rebuild_active_shortage(cur)
+
+def migration_add_shortage_changelog(cur):
+    """ Legt die Tabelle für das Änderungsprotokoll zwischen BASG-Exporten an. """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS shortage_changelog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            imported_at TEXT NOT NULL,
+            change_type TEXT NOT NULL, -- 'inserted', 'changed' oder 'removed'
+            Name TEXT,
+            "Datum der Meldung" TEXT,
+            old_values TEXT, -- JSON der Zeile vor der Änderung
+            new_values TEXT  -- JSON der Zeile nach der Änderung
+        )""")
+
+def migration_add_import_state(cur):
+    """ Legt die Tabelle für Fingerabdrücke des zuletzt importierten Exports an. """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS shortage_import_state (
+            key TEXT PRIMARY KEY, -- 'file_sha256' oder 'rows_sha256'
+            value TEXT,
+            updated_at TEXT
+        )""")
+
+def migration_add_asp_revision(cur):
+    """
+    Änderungszähler für asp: Trigger zählen jede eingefügte, geänderte oder
+    gelöschte Zeile mit, auch bei Änderungen von Hand (z.B. DB Browser).
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS asp_revision (revision INTEGER NOT NULL)")
+    if cur.execute("SELECT COUNT(*) FROM asp_revision").fetchone()[0] == 0:
+        cur.execute("INSERT INTO asp_revision (revision) VALUES (0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS asp_revision_{event.lower()} AFTER {event} ON asp
+            BEGIN UPDATE asp_revision SET revision = revision + 1; END""")
+
+SCHEMA_MIGRATIONS = [
+    (1, "Indizes auf asp.Name, asp.ATC_Code und shortage.Name", migration_add_lookup_indexes),
+    (2, "Status- und Datumsspalten in shortage", migration_add_shortage_derived_columns),
+    (3, "Tabelle active_shortage", migration_add_active_shortage),
+    (4, "Tabelle shortage_changelog", migration_add_shortage_changelog),
+    (5, "Tabelle shortage_import_state", migration_add_import_state),
+    (6, "Änderungszähler für asp", migration_add_asp_revision),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# SQL-Form der Nachschlage-Abfragen, für die die Indizes oben angelegt werden.
+# Im Anfragepfad beantwortet der Drug-Index sie aus dem Speicher; benchmark.py
+# führt genau diese Abfragen als Vergleichsbasis aus, tests/test_migrations.py
+# prüft per EXPLAIN QUERY PLAN, dass jede davon einen Index nutzt.
+SQL_ACTIVE_SHORTAGE_BY_NAME = "SELECT 1 FROM active_shortage WHERE Name = ? LIMIT 1"
+SQL_SHORTAGE_STATUS_BY_NAME = "SELECT Status FROM shortage WHERE Name = ?"
+SQL_ASP_DETAILS_BY_NAME = "SELECT Name, ATC_Code, Zulassungsnummer FROM asp WHERE Name = ?"
+SQL_ASP_BY_ATC_PREFIX = "SELECT Name, ATC_Code, Zulassungsnummer FROM asp WHERE ATC_Code LIKE ? AND Name != ?"
+SQL_ASP_NAME_PREFIX = "SELECT Name FROM asp WHERE Name LIKE ? LIMIT 15"
+LOOKUP_QUERIES = {
+    "check_shortage": (SQL_ACTIVE_SHORTAGE_BY_NAME, ("Ibuprofen",)),
+    "get_shortage_status": (SQL_SHORTAGE_STATUS_BY_NAME, ("Ibuprofen",)),
+    "get_medication_details_by_name": (SQL_ASP_DETAILS_BY_NAME, ("Ibuprofen",)),
+    "find_alternatives": (SQL_ASP_BY_ATC_PREFIX, ("N02BE%", "Ibuprofen")),
+    "autocomplete": (SQL_ASP_NAME_PREFIX, ("Ibu%",)),
+}
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_with_write_db():
+    """ migrate_database über die Schreib-Verbindung. Rückgabe wie migrate_database. """
+    conn = get_write_db()
+    if not conn: raise sqlite3.OperationalError("Keine Schreib-Verbindung für die Schema-Migration")
     try:
+        return migrate_database(conn)
+    finally:
+        release_write_db()
+
+def migrate_database(conn):
+    """
+    Spielt alle noch fehlenden Migrationen ein, jede in einer eigenen Transaktion
+    zusammen mit dem Hochsetzen von user_version. Mehrfacher Aufruf ist harmlos.
+    Danach ANALYZE, damit der Query-Planer die neuen Indizes auch nutzt.
+    Rückgabe: Liste der eingespielten Versionen.
+    """
+    applied = []
+    for version, description, migration in SCHEMA_MIGRATIONS:
+        if get_schema_version(conn) >= version: continue
         cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            if get_schema_version(conn) >= version: # Anderer Prozess war schneller
+                conn.rollback(); continue
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append(version)
+        print(f"Schema-Migration {version} eingespielt: {description}")
+    if applied:
+        conn.execute("ANALYZE")
+        conn.commit()
+    return applied
+
+# --- Autocomplete-Index (sortiertes Array + bisect) ---
+def normalize_search_text(text):
+    """
+    Normalisiert Namen/Suchbegriffe: ohne Groß-/Kleinschreibung und ohne
+    diakritische Zeichen (z.B. 'Präparat' -> 'praparat', 'ß' -> 'ss').
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+class AutocompleteIndex:
+    """
+    Präfixsuche über alle asp-Namen. Die normalisierten Namen liegen sortiert
+    in einer Liste, ein Präfix ist damit ein zusammenhängender Bereich, der
+    per bisect in O(log n) gefunden wird.
+    """
+    def __init__(self, names):
+        entries = sorted({(normalize_search_text(name), name) for name in names})
+        self.keys = [key for key, _ in entries]
+        self.names = [name for _, name in entries]
 
-        # --- Query sucht NUR nach dem Namen, ignoriert Status ---
-        query = """
-            SELECT 1
-            FROM shortage
-            WHERE Name = ?
-            LIMIT 1
+    def search(self, search_term, limit=15):
         """
+        Liefert bis zu `limit` Namen mit passendem Präfix, direkt aus dem
+        sortierten Bereich: exakter Treffer zuerst (er sortiert vor allen
+        Verlängerungen), dann alphabetisch. Aufwand O(log n + limit).
+        """
+        term = normalize_search_text(search_term.strip())
+        if not term: return []
+        start = bisect.bisect_left(self.keys, term)
+        end = min(start + limit, len(self.keys))
+        results = []
+        for i in range(start, end):
+            if not self.keys[i].startswith(term): break
+            results.append(self.names[i])
+        return results
 
-        # --- Aufruf nur mit dem Namen als Parameter ---
-        cur.execute(query, (name,)) # Nur 'name' übergeben
 
-        result = cur.fetchone()
-        # is_present ist True, wenn irgendein Eintrag mit dem Namen gefunden wurde
-        is_present = result is not None
+# --- Fuzzy-Index (invertierter Trigramm-Index) ---
+FUZZY_MIN_SIMILARITY = 0.5 # Anteil der Trigramme des Suchbegriffs, die im Namen vorkommen müssen
+FUZZY_MAX_POSTINGS = 4_000_000 # Speicherbudget: max. Einträge (je 4 Byte) über alle Posting-Listen
+FUZZY_RERANK_LIMIT = 200 # Kandidaten, die mit allen Trigrammen exakt bewertet werden
 
-    except sqlite3.Error as e:
-        # Fehlermeldung angepasst
-        print(f"!!! Datenbankfehler bei shortage-Abfrage (nur nach Name) für '{name}': {e}")
-        is_present = None # DB-Fehler signalisieren
-    except Exception as e_generic:
-         print(f"!!! Unerwarteter Fehler in check_shortage für Name '{name}': {e_generic}")
-         is_present = None
-    finally:
-        # Sicherstellen, dass die Verbindung geschlossen wird
-        if conn:
-            conn.close()
+def name_trigrams(normalized_text, pad_end=True):
+    """
+    Zerlegt einen normalisierten Text wortweise in Trigramme. Jedes Wort wird
+    vorne (und optional hinten) mit Leerzeichen gepolstert, damit Wortanfänge
+    stärker zählen. Für Suchbegriffe ohne hinteres Polster, weil das letzte
+    Wort beim Tippen meist noch unvollständig ist.
+    """
+    trigrams = set()
+    for word in normalized_text.split():
+        padded = " " + word + (" " if pad_end else "")
+        for i in range(len(padded) - 2):
+            trigrams.add(padded[i:i + 3])
+    return trigrams
 
-    # Gibt True (Name gefunden), False (Name nicht gefunden) oder None (Fehler) zurück
-    # WICHTIG: True bedeutet jetzt nicht mehr zwingend "aktiver Engpass"!
-    return is_present
+class FuzzyNameIndex:
+    """
+    Teilstring- und tippfehlertolerante Suche über alle asp-Namen.
+    Trigramm -> sortiertes uint32-Array der Namens-IDs. Liegt die Summe der
+    Posting-Listen über FUZZY_MAX_POSTINGS, werden die häufigsten (und damit
+    unspezifischsten) Trigramme verworfen; beim exakten Nachbewerten der
+    Kandidaten zählen sie trotzdem mit.
+    Der Aufbau läuft in zwei Durchgängen (erst zählen, dann in vorab
+    angelegte Arrays füllen), damit auch der Spitzenverbrauch beim Bauen
+    im Budget bleibt und keine Python-Listen aller Postings entstehen.
+    """
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self.keys = [normalize_search_text(name) for name in self.names]
+        counts = {}
+        for key in self.keys:
+            for trigram in name_trigrams(key):
+                counts[trigram] = counts.get(trigram, 0) + 1
+        self.postings = {}
+        total = 0
+        for trigram, count in sorted(counts.items(), key=lambda item: item[1]): # seltene zuerst
+            if total + count > FUZZY_MAX_POSTINGS: break
+            self.postings[trigram] = np.empty(count, dtype=np.uint32)
+            total += count
+        fill = dict.fromkeys(self.postings, 0) # Schreibposition je Trigramm
+        for name_id, key in enumerate(self.keys): # IDs aufsteigend -> Arrays bleiben sortiert
+            for trigram in name_trigrams(key):
+                position = fill.get(trigram)
+                if position is None: continue # verworfenes Trigramm
+                self.postings[trigram][position] = name_id
+                fill[trigram] = position + 1
+        self.total_postings = total
+        self.dropped_trigrams = frozenset(counts.keys() - self.postings.keys())
+        self.trigrams_by_bigram = {} # Für Fragmente aus zwei Zeichen, auch mitten im Wort ('bu' in 'ibuprofen')
+        for trigram in counts:
+            for bigram in {trigram[:2], trigram[1:]}:
+                if " " not in bigram: self.trigrams_by_bigram.setdefault(bigram, []).append(trigram)
 
-def get_medication_details_by_name(name):
-    """ Holt ATC-Code etc. aus der asp-Tabelle. """
-    if not name: return None
+    def search(self, search_term, limit=15):
+        """
+        Liefert bis zu `limit` Tupel (Name, Ähnlichkeit 0..1), absteigend nach
+        Ähnlichkeit, bei Gleichstand kürzere Namen zuerst. Namen werden nur
+        linear durchsucht, wenn ausschließlich verworfene Trigramme getippt
+        wurden; Begriffe ohne bekanntes Trigramm liefern sofort [].
+        """
+        term = normalize_search_text(search_term.strip())
+        query_trigrams = name_trigrams(term, pad_end=False)
+        if not query_trigrams or not self.names: return []
+        if len(term) == 2:
+            candidate_ids = self.fragment_candidates(term)
+            return self.rank(term, query_trigrams, candidate_ids, limit)
+        hit_lists = [self.postings[t] for t in query_trigrams if t in self.postings]
+        if hit_lists:
+            # Treffer pro Name zählen (vektorisiert), dann die besten Kandidaten herausgreifen
+            hit_counts = np.bincount(np.concatenate(hit_lists), minlength=len(self.names))
+            top_k = min(FUZZY_RERANK_LIMIT, len(hit_counts))
+            candidate_ids = np.argpartition(-hit_counts, top_k - 1)[:top_k]
+            candidate_ids = [int(name_id) for name_id in candidate_ids if hit_counts[name_id] > 0]
+        elif query_trigrams & self.dropped_trigrams:
+            # Nur verworfene (sehr häufige) Trigramme getippt: auf Teilstringsuche in den Namen zurückfallen
+            candidate_ids = list(itertools.islice((name_id for name_id, key in enumerate(self.keys) if term in key), FUZZY_RERANK_LIMIT))
+        else:
+            return [] # Kein Trigramm kommt in irgendeinem Namen vor (Tippfehler, Unsinn)
+        return self.rank(term, query_trigrams, candidate_ids, limit)
+
+    def fragment_candidates(self, fragment):
+        """
+        Namens-IDs (höchstens FUZZY_RERANK_LIMIT, alphabetisch), die das
+        Zwei-Zeichen-Fragment enthalten: Vereinigung der Posting-Listen aller
+        Trigramme, in denen es vorkommt.
+        """
+        trigrams = self.trigrams_by_bigram.get(fragment, [])
+        if not trigrams: return []
+        if any(t in self.dropped_trigrams for t in trigrams): # Sehr häufiges Fragment: Treffer kommen beim Scan schnell
+            return list(itertools.islice((name_id for name_id, key in enumerate(self.keys) if fragment in key), FUZZY_RERANK_LIMIT))
+        # Arrays sind sortiert: die kleinsten IDs der Vereinigung stecken in den Anfängen der einzelnen Listen
+        heads = [self.postings[t][:FUZZY_RERANK_LIMIT] for t in trigrams]
+        return [int(name_id) for name_id in np.unique(np.concatenate(heads))[:FUZZY_RERANK_LIMIT]]
+
+    def rank(self, term, query_trigrams, candidate_ids, limit):
+        """ Bewertet die Kandidaten exakt und liefert die besten `limit` Tupel (Name, Ähnlichkeit). """
+        scored = []
+        for name_id in candidate_ids:
+            key = self.keys[name_id]
+            similarity = 1.0 if term in key else len(query_trigrams & name_trigrams(key)) / len(query_trigrams)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                scored.append((-similarity, len(key), self.names[name_id], similarity))
+        return [(name, round(similarity, 3)) for _, _, name, similarity in heapq.nsmallest(limit, scored)]
+
+
+# --- ATC-Hierarchie (Ebenen 1-5) ---
+# Ebene -> Länge des ATC-Präfixes, z.B. N02BE01: N / N02 / N02B / N02BE / N02BE01
+ATC_LEVEL_PREFIX_LENGTHS = {1: 1, 2: 3, 3: 4, 4: 5, 5: 7}
+ATC_LEVEL_NAMES = {
+    1: "anatomische Hauptgruppe",
+    2: "therapeutische Untergruppe",
+    3: "pharmakologische Untergruppe",
+    4: "chemische Untergruppe",
+    5: "chemische Substanz"
+}
+ALTERNATIVES_MIN_COUNT = 3 # Weniger verfügbare Alternativen -> Suche auf die nächsthöhere Ebene ausweiten
+ALTERNATIVES_WIDEST_LEVEL = 3 # Nicht über die pharmakologische Untergruppe hinaus ausweiten
+
+def atc_level_prefixes(atc_code):
+    """ Liefert [(Ebene, Präfix)] vom spezifischsten zum allgemeinsten Knoten eines ATC-Codes. """
+    atc_code = atc_code.strip().upper()
+    return [(level, atc_code[:length]) for level, length in sorted(ATC_LEVEL_PREFIX_LENGTHS.items(), reverse=True)
+            if length <= len(atc_code)]
+
+class AtcHierarchy:
+    """
+    Baum über alle ATC-Codes der asp-Tabelle. Jeder Knoten (Präfix einer
+    Ebene 1-5) kennt seine Mitglieder in asp-Reihenfolge, damit jede Ebene
+    per Dict-Lookup statt per LIKE-Scan abgefragt werden kann.
+    """
+    def __init__(self, details_iterable):
+        members = {}
+        for details in details_iterable:
+            atc_code = details.get("ATC_Code")
+            if not atc_code: continue
+            for _, prefix in atc_level_prefixes(atc_code):
+                members.setdefault(prefix, []).append(details)
+        self.members = {prefix: tuple(node_members) for prefix, node_members in members.items()}
+
+    def level_members(self, prefix):
+        return self.members.get(prefix.upper(), ())
+
+    def node_counts(self):
+        """ Anzahl Knoten je Ebene (für die Statusanzeige). """
+        counts = {level: 0 for level in ATC_LEVEL_PREFIX_LENGTHS}
+        lengths = {length: level for level, length in ATC_LEVEL_PREFIX_LENGTHS.items()}
+        for prefix in self.members:
+            if len(prefix) in lengths: counts[lengths[len(prefix)]] += 1
+        return counts
+
+
+# --- In-Memory-Index (Schnappschuss von asp und shortage) ---
+class DrugIndex:
+    """
+    Unveränderlicher Schnappschuss der Tabellen asp und shortage.
+    Wird nie verändert, sondern bei einem DB-Update komplett ersetzt.
+    """
+    def __init__(self, details_by_name, active_shortage_names, shortage_status_by_name, atc_hierarchy, autocomplete_index, fuzzy_index, version):
+        self.details_by_name = details_by_name # Name -> {Name, ATC_Code, Zulassungsnummer}
+        self.active_shortage_names = active_shortage_names # frozenset der Namen in active_shortage
+        self.shortage_status_by_name = shortage_status_by_name # Name -> Status der maßgeblichen Meldung (auch beendete)
+        self.atc_hierarchy = atc_hierarchy # AtcHierarchy über alle ATC-Codes
+        self.autocomplete_index = autocomplete_index # AutocompleteIndex über alle Namen
+        self.fuzzy_index = fuzzy_index # FuzzyNameIndex über alle Namen
+        self.version = version
+        self.built_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.asp_fingerprint = None # asp_fingerprint() zum Zeitpunkt des Aufbaus
+
+_drug_index = None
+_drug_index_version = 0
+_drug_index_lock = threading.Lock()
+_drug_index_checked_at = 0.0 # time.monotonic() der letzten Prüfung auf geänderte asp-Tabelle
+_drug_index_check_lock = threading.Lock()
+
+def asp_fingerprint(conn):
+    """ Billiger Fingerabdruck der asp-Tabelle: (Zeilen, größte rowid, Änderungszähler). """
+    return tuple(conn.execute("SELECT COUNT(*), MAX(rowid), (SELECT revision FROM asp_revision) FROM asp").fetchone())
+
+@timed("build_drug_index")
+def build_drug_index(conn, version):
+    """ Liest asp und shortage einmalig und baut daraus einen DrugIndex. """
+    cur = conn.cursor()
+    details_by_name = {}
+    cur.execute("SELECT Name, ATC_Code, Zulassungsnummer FROM asp")
+    for row in cur.fetchall():
+        details = dict(row)
+        name = details.get("Name")
+        if not name: continue
+        if name in details_by_name: continue # wie fetchone(): erster Treffer gewinnt
+        details_by_name[name] = details
+    cur.execute("SELECT Name FROM active_shortage")
+    active_shortage_names = frozenset(row["Name"] for row in cur.fetchall())
+    shortage_status_by_name = {row[0]: row[1] for row in deciding_shortage_reports(cur)}
+    index = DrugIndex(details_by_name, active_shortage_names, shortage_status_by_name, AtcHierarchy(details_by_name.values()), AutocompleteIndex(details_by_name), FuzzyNameIndex(details_by_name), version)
+    index.asp_fingerprint = asp_fingerprint(conn)
+    return index
+
+def refresh_drug_index(only_if_missing=False):
+    """
+    Baut den Index neu auf und tauscht ihn atomar aus.
+    Laufende Anfragen arbeiten mit dem alten Schnappschuss weiter.
+    only_if_missing: nur bauen, wenn noch kein Index existiert (erster Zugriff);
+    gleichzeitige Erstzugriffe warten dann auf einen einzigen Aufbau.
+    Rückgabe: der neue Index oder None bei DB-Fehler (alter Index bleibt aktiv).
+    """
+    global _drug_index, _drug_index_version
     conn = get_db()
-    if not conn: return None
-    details = None
+    if not conn:
+        print("FEHLER: Drug-Index konnte keine DB-Verbindung herstellen.")
+        return None
     try:
-        cur = conn.cursor()
-        query = "SELECT Name, ATC_Code, Zulassungsnummer FROM asp WHERE Name = ?"
-        cur.execute(query, (name,))
-        result = cur.fetchone()
-        if result: details = dict(result)
+        # active_shortage & Co. müssen existieren; vor _drug_index_lock, damit die Sperren
+        # immer in der Reihenfolge Schreib-Verbindung -> Index-Lock genommen werden
+        if get_schema_version(conn) < SCHEMA_VERSION: migrate_with_write_db()
     except sqlite3.Error as e:
-        print(f"!!! Fehler bei Detail-Abfrage für Name '{name}': {e}")
-        details = None
-    finally:
-         if conn: conn.close()
-    return details
+        print(f"!!! Schema-Migration fehlgeschlagen: {e}")
+        return None
+    with _drug_index_lock:
+        if only_if_missing and _drug_index is not None:
+            return _drug_index # Ein anderer Thread hat ihn inzwischen gebaut
+        try:
+            conn.execute("BEGIN") # Alle Tabellen aus demselben Commit lesen
+            new_index = build_drug_index(conn, _drug_index_version + 1)
+        except sqlite3.Error as e:
+            print(f"!!! Datenbankfehler beim Aufbau des Drug-Index: {e}")
+            return None
+        finally:
+            if conn.in_transaction: conn.rollback()
+        _drug_index_version = new_index.version
+        _drug_index = new_index # Zuweisung einer Referenz ist atomar
+        print(f"Drug-Index v{new_index.version} aktiv: {len(new_index.details_by_name)} Medikamente, {len(new_index.active_shortage_names)} aktive Engpässe ({len(new_index.shortage_status_by_name)} gemeldete Namen).")
+        return new_index
 
-def find_alternatives(atc_code, original_name):
-    """ Findet verfügbare Alternativen in der gleichen ATC-Gruppe. """
-    if not atc_code or len(atc_code) < 2: return []
-    if not original_name: return []
-    atc_group_prefix = atc_code[:-2]
-    atc_search_pattern = atc_group_prefix + "%"
+def refresh_drug_index_if_stale():
+    """
+    Baut den Index neu auf, wenn sich asp seit seinem Aufbau geändert hat
+    (z.B. von Hand nachgeladen). Ohne bestehenden Index passiert nichts.
+    Rückgabe: der neue Index oder None, wenn keiner gebaut wurde.
+    """
+    global _drug_index_checked_at
+    _drug_index_checked_at = time.monotonic()
+    index = _drug_index
     conn = get_db()
-    if not conn: return None
-    potential_alternatives = []
-    available_alternatives = []
+    if index is None or not conn: return None
     try:
-        cur = conn.cursor()
-        query_alternatives = """
-            SELECT Name, ATC_Code, Zulassungsnummer
-            FROM asp WHERE ATC_Code LIKE ? AND Name != ? """
-        cur.execute(query_alternatives, (atc_search_pattern, original_name))
-        potential_alternatives = [dict(row) for row in cur.fetchall()]
+        if get_schema_version(conn) >= SCHEMA_VERSION and asp_fingerprint(conn) == index.asp_fingerprint: return None
     except sqlite3.Error as e:
-        print(f"!!! Fehler bei Alternativensuche: {e}")
-        if conn: conn.close(); return None
-    finally:
-        if conn: conn.close()
-    if not potential_alternatives: return []
-    for alt in potential_alternatives:
-        alt_name = alt.get("Name")
-        if not alt_name: continue
-        is_alt_in_shortage = check_shortage(alt_name)
-        if is_alt_in_shortage is None: continue
-        if not is_alt_in_shortage: available_alternatives.append(alt)
-    return available_alternatives
+        print(f"!!! Prüfung der asp-Tabelle fehlgeschlagen: {e}")
+        return None
+    print("Tabelle asp wurde geändert, baue den Drug-Index neu auf.")
+    return refresh_drug_index()
+
+def get_drug_index():
+    """
+    Liefert den aktuellen Schnappschuss; baut ihn beim ersten Zugriff auf.
+    Höchstens alle DRUG_INDEX_STALE_CHECK_SECONDS prüft eine Anfrage, ob asp
+    geändert wurde; die übrigen arbeiten solange mit dem alten Stand weiter.
+    """
+    index = _drug_index
+    if index is None:
+        return refresh_drug_index(only_if_missing=True)
+    if time.monotonic() - _drug_index_checked_at >= DRUG_INDEX_STALE_CHECK_SECONDS and _drug_index_check_lock.acquire(blocking=False):
+        try:
+            index = refresh_drug_index_if_stale() or index
+        finally:
+            _drug_index_check_lock.release()
+    return index
+
+@timed("check_shortage")
+def check_shortage(name):
+    """
+    Prüft, ob für einen Medikamenten-NAME ein *aktiver* Engpass besteht
+    (Eintrag in active_shortage, siehe rebuild_active_shortage).
+    Rückgabe: True bei aktivem Engpass, False sonst, None bei DB-Fehler.
+    """
+    # Eingabevalidierung
+    if not name:
+        print("Warnung: check_shortage ohne Namen aufgerufen.")
+        return False # Kein Name, kein Eintrag
+
+    index = get_drug_index()
+    if index is None:
+        print("FEHLER: check_shortage hat keinen Drug-Index (DB nicht erreichbar).")
+        return None # DB-Fehler signalisieren
+
+    return name in index.active_shortage_names
+
+def get_shortage_status(name):
+    """ Status der maßgeblichen BASG-Meldung zu einem Namen (auch beendete), sonst None. """
+    if not name: return None
+    index = get_drug_index()
+    if index is None: return None
+    return index.shortage_status_by_name.get(name)
+
+@timed("get_medication_details_by_name")
+def get_medication_details_by_name(name):
+    """ Holt ATC-Code etc. aus dem asp-Schnappschuss. """
+    if not name: return None
+    index = get_drug_index()
+    if index is None: return None
+    details = index.details_by_name.get(name)
+    return dict(details) if details else None
+
+@timed("find_alternatives")
+def find_alternatives(atc_code, original_name, min_count=None, group_cache=None, index=None):
+    """
+    Findet verfügbare Alternativen entlang der ATC-Hierarchie: zuerst gleiche
+    Substanz (Ebene 5) und chemische Untergruppe (Ebene 4), dann - solange
+    weniger als `min_count` gefunden wurden - die nächsthöheren Ebenen bis
+    ALTERNATIVES_WIDEST_LEVEL. Sortiert nach Nähe im Baum (ATC_Level absteigend).
+    group_cache/index: optional für Batch-Prüfungen (Präfix -> verfügbare Mitglieder, fester Schnappschuss).
+    """
+    if not atc_code or len(atc_code) < 2: return []
+    if not original_name: return []
+    if min_count is None: min_count = ALTERNATIVES_MIN_COUNT
+    if index is None: index = get_drug_index()
+    if index is None: return None
+    if group_cache is None: group_cache = {}
+    alternatives = []
+    seen_names = {original_name}
+    for level, prefix in atc_level_prefixes(atc_code):
+        if level < ALTERNATIVES_WIDEST_LEVEL: break
+        if prefix not in group_cache:
+            group_cache[prefix] = available_group_members(index, prefix)
+        for alt in group_cache[prefix]:
+            if alt["Name"] in seen_names: continue
+            seen_names.add(alt["Name"])
+            alternatives.append(dict(alt, ATC_Level=level, ATC_Ebene=ATC_LEVEL_NAMES[level]))
+        if level <= 4 and len(alternatives) >= min_count: break
+    return alternatives
+
+def available_group_members(index, atc_group_prefix):
+    """ Alle Medikamente eines ATC-Knotens ohne aktiven Engpass. """
+    active_shortage_names = index.active_shortage_names
+    return [alt for alt in index.atc_hierarchy.level_members(atc_group_prefix) if alt["Name"] not in active_shortage_names]
+
+@timed("autocomplete")
+def autocomplete_names(search_term, limit=15):
+    """ Liefert bis zu `limit` Namen, die mit search_term beginnen (ohne Groß-/Kleinschreibung und Umlaute). """
+    index = get_drug_index()
+    if index is None: return []
+    return index.autocomplete_index.search(search_term, limit)
+
+@timed("fuzzy_search")
+def fuzzy_search_names(search_term, limit=15):
+    """ Teilstring-/Tippfehlersuche; liefert Liste von (Name, Ähnlichkeit). """
+    index = get_drug_index()
+    if index is None: return []
+    return index.fuzzy_index.search(search_term, limit)
+
+# --- Warten auf den Abschluss eines Browser-Downloads ---
+def wait_for_download(download_dir, filename, timeout_seconds=None, poll_interval=None, stable_checks=None):
+    """
+    Wartet, bis `filename` in `download_dir` vollständig ist: keine
+    .crdownload-Datei mehr vorhanden und die Dateigröße über
+    `stable_checks` Abfragen unverändert (> 0 Byte). Kehrt sofort zurück,
+    sobald das zutrifft, spätestens nach `timeout_seconds`.
+    Rückgabe: (fertig?, gemessene Dauer in Sekunden, laufende .crdownload-Dateien).
+    """
+    if timeout_seconds is None: timeout_seconds = DOWNLOAD_WAIT_SECONDS
+    if poll_interval is None: poll_interval = DOWNLOAD_POLL_INTERVAL_SECONDS
+    if stable_checks is None: stable_checks = DOWNLOAD_STABLE_CHECKS
+    target_path = os.path.join(download_dir, filename)
+    start = time.monotonic()
+    last_size = None
+    stable_count = 0
+    while True:
+        ongoing_downloads = [f for f in os.listdir(download_dir) if f.lower().endswith('.crdownload')]
+        size = os.path.getsize(target_path) if os.path.exists(target_path) else None
+        if size and not ongoing_downloads:
+            stable_count = stable_count + 1 if size == last_size else 0
+            if stable_count >= stable_checks:
+                return True, time.monotonic() - start, []
+        else:
+            stable_count = 0
+        last_size = size
+        if time.monotonic() - start >= timeout_seconds:
+            return False, time.monotonic() - start, ongoing_downloads
+        time.sleep(poll_interval)
+
+
+# --- Warmer Browser für wiederholte BASG-Exporte ---
+_chromedriver_path = None
+
+def get_chromedriver_path():
+    """ Löst den ChromeDriver einmal pro Prozess über webdriver-manager auf und merkt sich den Pfad. """
+    global _chromedriver_path
+    if _chromedriver_path is None or not os.path.exists(_chromedriver_path):
+        _chromedriver_path = ChromeDriverManager().install()
+    return _chromedriver_path
+
+def create_chrome_driver():
+    """ Startet einen Headless-Chrome, der direkt nach DOWNLOAD_DIR herunterlädt. """
+    chrome_options = Options()
+    prefs = {"download.default_directory": DOWNLOAD_DIR,"download.prompt_for_download": False,"download.directory_upgrade": True,"plugins.always_open_pdf_externally": True}
+    chrome_options.add_experimental_option("prefs", prefs)
+    chrome_options.add_argument("--headless=new"); chrome_options.add_argument("--disable-gpu"); chrome_options.add_argument("--window-size=1920,1080")
+    chrome_options.add_argument('--ignore-certificate-errors'); chrome_options.add_argument('--allow-running-insecure-content')
+    chrome_options.add_argument(f'user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36')
+    service = ChromeService(executable_path=get_chromedriver_path())
+    return webdriver.Chrome(service=service, options=chrome_options)
+
+class WarmBrowserPool:
+    """
+    Hält einen einzelnen WebDriver zwischen Downloads offen. Vor jeder
+    Ausgabe wird er auf Erreichbarkeit geprüft; nach WEBDRIVER_MAX_USES
+    Verwendungen oder nach einem Fehler wird er geschlossen und beim
+    nächsten Mal neu gestartet.
+    """
+    def __init__(self, max_uses):
+        self.max_uses = max_uses
+        self.driver = None
+        self.uses = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, log_messages):
+        """ Liefert einen funktionierenden Driver; blockiert, solange ein anderer Download läuft. """
+        self.lock.acquire()
+        try:
+            if self.driver is not None and not self.is_healthy():
+                log_messages.append("Warmer Browser reagiert nicht mehr, starte neu."); print(log_messages[-1])
+                self.close()
+            if self.driver is None:
+                log_messages.append("Starte den Chrome WebDriver im Hintergrund..."); print(log_messages[-1])
+                self.driver = create_chrome_driver()
+                self.uses = 0
+            else:
+                log_messages.append(f"Verwende warmen Browser (Nutzung {self.uses + 1}/{self.max_uses})."); print(log_messages[-1])
+            return self.driver
+        except Exception:
+            self.lock.release()
+            raise
+
+    def release(self, log_messages, failed=False):
+        """ Gibt den Driver zurück; schließt ihn nach einem Fehler oder Erreichen des Limits. """
+        try:
+            self.uses += 1
+            if failed or self.uses >= self.max_uses:
+                log_messages.append("Schließe den Hintergrund-Browser."); print(log_messages[-1])
+                self.close()
+        finally:
+            self.lock.release()
+
+    def is_healthy(self):
+        try:
+            self.driver.current_url # Round-Trip zum Driver
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        if self.driver is not None:
+            try: self.driver.quit()
+            except Exception as e: print(f"Warnung: Browser konnte nicht sauber beendet werden: {e}")
+        self.driver = None
+        self.uses = 0
+
+    def shutdown(self):
+        """ Beim Prozessende aufrufen (atexit). """
+        with self.lock:
+            self.close()
+
+_browser_pool = WarmBrowserPool(WEBDRIVER_MAX_USES)
+atexit.register(_browser_pool.shutdown)
+
 
 # --- Funktion: Download mit Selenium ---
-def download_shortage_list():
-    """ Versucht, die Excel-Datei von der BASG-Seite mit Selenium herunterzuladen."""
-    # (Code für download_shortage_list bleibt unverändert von vorheriger Antwort)
-    # [Code der Funktion hier einfügen...]
-    log_messages = []
+@timed("basg_download")
+def download_shortage_list(log_messages=None):
+    """
+    Versucht, die Excel-Datei von der BASG-Seite mit Selenium herunterzuladen.
+    Optional wird in eine übergebene Liste geloggt (z.B. die eines Hintergrund-Jobs),
+    damit der Fortschritt schon während des Downloads sichtbar ist.
+    """
+    if log_messages is None: log_messages = []
     log_messages.append(f"Download-Verzeichnis: {DOWNLOAD_DIR}")
     print(log_messages[-1])
     log_messages.append(f"Prüfe auf alte Datei: {DOWNLOAD_FILE_PATH}")
@@ -168,18 +1032,15 @@ def download_shortage_list():
         except Exception as e:
             msg = f"FEHLER: Alte Datei '{EXPECTED_DOWNLOAD_FILENAME}' konnte nicht gelöscht werden: {e}"
             log_messages.append(msg); print(f"!!! {msg}"); return None, log_messages
-    chrome_options = Options()
-    prefs = {"download.default_directory": DOWNLOAD_DIR,"download.prompt_for_download": False,"download.directory_upgrade": True,"plugins.always_open_pdf_externally": True}
-    chrome_options.add_experimental_option("prefs", prefs)
-    chrome_options.add_argument("--headless=new"); chrome_options.add_argument("--disable-gpu"); chrome_options.add_argument("--window-size=1920,1080")
-    chrome_options.add_argument('--ignore-certificate-errors'); chrome_options.add_argument('--allow-running-insecure-content')
-    chrome_options.add_argument(f'user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36')
     driver = None
-    log_messages.append("Starte den Chrome WebDriver im Hintergrund..."); print(log_messages[-1])
+    download_failed = False
     try:
-        service = ChromeService(executable_path=ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        log_messages.append("WebDriver gestartet."); print(log_messages[-1])
+        if WEBDRIVER_KEEP_WARM:
+            driver = _browser_pool.acquire(log_messages)
+        else:
+            log_messages.append("Starte den Chrome WebDriver im Hintergrund..."); print(log_messages[-1])
+            driver = create_chrome_driver()
+        log_messages.append("WebDriver bereit."); print(log_messages[-1])
         log_messages.append(f"Lade die Seite: {BASG_PAGE_URL}"); print(log_messages[-1])
         driver.get(BASG_PAGE_URL)
         log_messages.append(f"Warte auf Export-Button (ID: {EXPORT_BUTTON_ID})... (Max {SELENIUM_TIMEOUT_SECONDS}s)"); print(log_messages[-1])
@@ -187,23 +1048,28 @@ def download_shortage_list():
         export_button = wait.until(EC.element_to_be_clickable((By.ID, EXPORT_BUTTON_ID)))
         log_messages.append("Export-Button gefunden."); print(log_messages[-1])
         export_button.click()
-        log_messages.append(f"Klick ausgeführt. Warte {DOWNLOAD_WAIT_SECONDS}s auf den Download..."); print(log_messages[-1])
-        time.sleep(DOWNLOAD_WAIT_SECONDS)
-        if os.path.exists(DOWNLOAD_FILE_PATH):
+        log_messages.append(f"Klick ausgeführt. Warte auf den Download... (Max {DOWNLOAD_WAIT_SECONDS}s)"); print(log_messages[-1])
+        download_complete, download_seconds, ongoing_downloads = wait_for_download(DOWNLOAD_DIR, EXPECTED_DOWNLOAD_FILENAME)
+        if download_complete:
+            log_messages.append(f"Download-Dauer: {download_seconds:.1f}s"); print(log_messages[-1])
+        if os.path.exists(DOWNLOAD_FILE_PATH) and (download_complete or not ongoing_downloads):
              if os.path.getsize(DOWNLOAD_FILE_PATH) > 0:
                   msg = f"Download erfolgreich! Datei gefunden: {DOWNLOAD_FILE_PATH}"; log_messages.append(msg); print(msg); return DOWNLOAD_FILE_PATH, log_messages
              else:
                   msg = f"FEHLER: Heruntergeladene Datei '{EXPECTED_DOWNLOAD_FILENAME}' ist leer."; log_messages.append(msg); print(f"!!! {msg}")
                   try: os.remove(DOWNLOAD_FILE_PATH)
                   except: pass
+                  download_failed = True # Browser nicht warm halten, falls er noch etwas schreibt
                   return None, log_messages
         else:
-            ongoing_downloads = [f for f in os.listdir(DOWNLOAD_DIR) if f.lower().endswith('.crdownload')]
-            if ongoing_downloads: msg = f"FEHLER: Download scheint nach {DOWNLOAD_WAIT_SECONDS}s noch zu laufen ({ongoing_downloads}). Erhöhe DOWNLOAD_WAIT_SECONDS oder prüfe manuell."
+            if ongoing_downloads: msg = f"FEHLER: Download scheint nach {download_seconds:.1f}s noch zu laufen ({ongoing_downloads}). Erhöhe DOWNLOAD_WAIT_SECONDS oder prüfe manuell."
             else: msg = f"FEHLER: Datei '{EXPECTED_DOWNLOAD_FILENAME}' wurde nach Klick nicht im Verzeichnis gefunden. Download fehlgeschlagen?"
-            log_messages.append(msg); print(f"!!! {msg}"); return None, log_messages
+            log_messages.append(msg); print(f"!!! {msg}")
+            download_failed = True # Ein noch laufender Download landete sonst im nächsten Job
+            return None, log_messages
     except Exception as e:
         msg = f"FEHLER während des Selenium Downloads: {e}"; log_messages.append(msg); print(f"!!! {msg}")
+        download_failed = True
         if driver:
             try:
                 screenshot_path = os.path.join(DOWNLOAD_DIR, "fehler_screenshot_download.png")
@@ -211,37 +1077,249 @@ def download_shortage_list():
             except Exception as screenshot_error: log_messages.append(f"Konnte keinen Screenshot erstellen: {screenshot_error}"); print(log_messages[-1])
         return None, log_messages
     finally:
-        if driver: log_messages.append("Schließe den Hintergrund-Browser."); print(log_messages[-1]); driver.quit()
+        if driver and WEBDRIVER_KEEP_WARM: _browser_pool.release(log_messages, failed=download_failed)
+        elif driver: log_messages.append("Schließe den Hintergrund-Browser."); print(log_messages[-1]); driver.quit()
 
 
 # --- Angepasste Funktion: DB Update aus Excel ---
-def update_database_from_excel(db_path, excel_path):
-    """Liest die heruntergeladene Excel-Datei und aktualisiert die shortage-Tabelle."""
-    log_messages = []
+
+# --- !!! HIER DAS MAPPING ANPASSEN AN DIE EXCEL-SPALTEN !!! ---
+# Links: Interne Schlüssel (egal wie sie heißen)
+# Rechts: Exakte Spaltenüberschriften aus deiner Excel-Datei!
+SHORTAGE_COL_MAP = {
+    'db_name': 'Name',
+    'db_verwendung': 'Verwendung',
+    'db_status': 'Status',
+    'db_details': 'Details', # Für die REAL-Spalte in der DB
+    'db_melder': 'Melder',
+    'db_pzn_nicht': 'PZN nicht verfügbarer Packungen',
+    'db_pzn_eingeschr': 'PZN eingeschränkt verfügbarer Packungen ', # Auf Tippfehler/Leerzeichen am Ende achten!
+    'db_pzn_wieder': 'PZN wieder verfügbarer Packungen ',
+    # 'ATC Code' wird ignoriert, da nicht in 'shortage'-Tabelle
+    'db_datum_meldung': 'Datum der Meldung',
+    'db_datum_aenderung': 'Datum der letzten Änderung'
+}
+
+# Spalten der shortage-Tabelle in der Reihenfolge von SHORTAGE_INSERT_QUERY
+SHORTAGE_DB_COLUMNS = [
+    "Name", "Verwendung", "Status", "Details", "Melder",
+    "PZN nicht verfügbarer Packungen",
+    "PZN eingeschränkt verfügbarer Packungen ",
+    "PZN wieder verfügbarer Packungen ",
+    "Datum der Meldung", "Datum der letzten Änderung"
+]
+SHORTAGE_KEY_POSITIONS = (0, 8) # Ein Eintrag ist eindeutig über Name + Datum der Meldung
+
+SHORTAGE_INSERT_QUERY = """
+    INSERT INTO shortage (
+        Name, Verwendung, Status, Details, Melder,
+        "PZN nicht verfügbarer Packungen",
+        "PZN eingeschränkt verfügbarer Packungen ",
+        "PZN wieder verfügbarer Packungen ",
+        "Datum der Meldung", "Datum der letzten Änderung"
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def normalize_text_column(series, default=''):
+    """ Spaltenweise Entsprechung von `str(x).strip() if pd.notna(x) else default`. """
+    values = series.astype(object) # Zeitstempel etc. wie bei str() pro Zelle darstellen
+    mask = values.notna()
+    result = pd.Series(default, index=series.index, dtype=object)
+    if mask.any():
+        result[mask] = values[mask].astype(str).str.strip()
+    return result
+
+def normalize_details_column(series):
+    """
+    Wandelt die 'Details'-Spalte vektorisiert in Zahlen um (Komma -> Punkt).
+    Rückgabe: (Series mit float oder None, Index der nicht umwandelbaren Zeilen).
+    """
+    values = series.astype(object)
+    mask = values.notna()
+    numbers = pd.Series(np.nan, index=series.index, dtype=float)
+    if mask.any():
+        as_text = values[mask].astype(str).str.strip().str.replace(',', '.', regex=False)
+        numbers[mask] = pd.to_numeric(as_text, errors='coerce')
+    rejected = series.index[mask & numbers.isna()]
+    return numbers.astype(object).where(numbers.notna(), None), rejected
+
+def normalize_shortage_dataframe(df, col_map):
+    """
+    Bereitet den Excel-DataFrame spaltenweise für das Einfügen vor.
+    Rückgabe: (Liste von Zeilen-Tupeln für SHORTAGE_INSERT_QUERY,
+               Liste der Excel-Zeilennummern, Liste der abgelehnten 'Details'-Werte).
+    """
+    names = normalize_text_column(df[col_map['db_name']])
+    keep = names != '' # Zeilen ohne Namen überspringen
+    df = df[keep]
+    details, rejected_index = normalize_details_column(df[col_map['db_details']])
+    columns = [
+        names[keep],
+        normalize_text_column(df[col_map['db_verwendung']]),
+        normalize_text_column(df[col_map['db_status']], default='UNBEKANNT'),
+        details,
+        normalize_text_column(df[col_map['db_melder']]),
+        normalize_text_column(df[col_map['db_pzn_nicht']]),
+        normalize_text_column(df[col_map['db_pzn_eingeschr']]),
+        normalize_text_column(df[col_map['db_pzn_wieder']]),
+        normalize_text_column(df[col_map['db_datum_meldung']]),
+        normalize_text_column(df[col_map['db_datum_aenderung']]),
+    ]
+    rows = list(zip(*(column.tolist() for column in columns)))
+    excel_line_numbers = [index + 2 for index in df.index] # +2: Kopfzeile und 1-basierte Zählung
+    rejected_details = [
+        (index + 2, names[index], df.at[index, col_map['db_details']]) for index in rejected_index
+    ]
+    return rows, excel_line_numbers, rejected_details
+
+def shortage_row_keys(rows):
+    """
+    Ordnet jeder Zeile ihren Schlüssel (Name, Datum der Meldung, n) zu.
+    n zählt Dubletten desselben Schlüssels durch, damit auch mehrfach
+    gemeldete Einträge stabil zugeordnet werden können.
+    """
+    seen = {}
+    keys = []
+    for row in rows:
+        base_key = tuple(row[pos] for pos in SHORTAGE_KEY_POSITIONS)
+        occurrence = seen.get(base_key, 0)
+        seen[base_key] = occurrence + 1
+        keys.append(base_key + (occurrence,))
+    return keys
+
+def compute_shortage_diff(existing_rows, new_rows):
+    """
+    Vergleicht den aktuellen Tabelleninhalt mit dem neuen Export.
+    existing_rows: Liste (rowid, Zeilen-Tupel), new_rows: Liste von Zeilen-Tupeln.
+    Rückgabe: dict mit 'inserted' [(Position in new_rows, neu)], 'changed'
+    [(rowid, alt, neu)], 'removed' [(rowid, alt)] und 'unchanged' (Anzahl).
+    """
+    existing_by_key = dict(zip(shortage_row_keys([row for _, row in existing_rows]), existing_rows))
+    diff = {"inserted": [], "changed": [], "removed": [], "unchanged": 0}
+    for position, (key, new_row) in enumerate(zip(shortage_row_keys(new_rows), new_rows)):
+        existing = existing_by_key.pop(key, None)
+        if existing is None:
+            diff["inserted"].append((position, new_row))
+        elif existing[1] != new_row:
+            diff["changed"].append((existing[0], existing[1], new_row))
+        else:
+            diff["unchanged"] += 1
+    diff["removed"] = list(existing_by_key.values())
+    return diff
+
+def get_import_fingerprints(cur):
+    """ Liefert {key: value} der gespeicherten Fingerabdrücke. """
+    return {row[0]: row[1] for row in cur.execute("SELECT key, value FROM shortage_import_state")}
+
+def store_import_fingerprints(cur, fingerprints):
+    """ Speichert Fingerabdrücke (läuft in der Transaktion des Aufrufers). """
+    updated_at = datetime.now().isoformat(timespec="seconds")
+    cur.executemany("INSERT OR REPLACE INTO shortage_import_state (key, value, updated_at) VALUES (?, ?, ?)",
+                    [(key, value, updated_at) for key, value in fingerprints.items()])
+
+def file_sha256(path):
+    """ SHA-256 einer Datei, blockweise gelesen. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def rows_sha256(rows):
+    """
+    SHA-256 der normalisierten Zeilen. Erkennt inhaltlich gleiche Exporte,
+    auch wenn sich die Datei selbst (z.B. Zeitstempel in den xlsx-Metadaten) unterscheidet.
+    """
+    return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def apply_shortage_diff(cur, diff, excel_line_numbers, log_messages):
+    """
+    Schreibt nur das Delta in die shortage-Tabelle und protokolliert es in
+    shortage_changelog. Läuft in der Transaktion des Aufrufers.
+    Rückgabe: Anzahl der tatsächlich eingefügten Zeilen.
+    """
+    imported_at = datetime.now().isoformat(timespec="seconds")
+    as_json = lambda row: json.dumps(dict(zip(SHORTAGE_DB_COLUMNS, row)), ensure_ascii=False)
+    set_clause = ", ".join(f'"{column}" = ?' for column in SHORTAGE_DB_COLUMNS)
+    set_clause += ", status_normalized = NULL" # abgeleitete Spalten neu berechnen lassen
+
+    cur.executemany("DELETE FROM shortage WHERE rowid = ?", [(rowid,) for rowid, _ in diff["removed"]])
+    cur.executemany(f"UPDATE shortage SET {set_clause} WHERE rowid = ?",
+                    [new_row + (rowid,) for rowid, _, new_row in diff["changed"]])
+    try:
+        cur.execute("SAVEPOINT shortage_bulk_insert")
+        cur.executemany(SHORTAGE_INSERT_QUERY, [new_row for _, new_row in diff["inserted"]])
+        cur.execute("RELEASE SAVEPOINT shortage_bulk_insert")
+        inserted = diff["inserted"]
+    except sqlite3.Error as e_bulk:
+        # Bulk-Load fehlgeschlagen: zeilenweise wiederholen, um die fehlerhaften Zeilen zu melden
+        print(f"!!! Bulk-Insert fehlgeschlagen ({e_bulk}), wiederhole zeilenweise...")
+        cur.execute("ROLLBACK TO SAVEPOINT shortage_bulk_insert")
+        cur.execute("RELEASE SAVEPOINT shortage_bulk_insert")
+        inserted = []
+        for position, new_row in diff["inserted"]:
+            try:
+                cur.execute(SHORTAGE_INSERT_QUERY, new_row)
+                inserted.append((position, new_row))
+            except sqlite3.Error as e_row:
+                msg = f"FEHLER in Excel Zeile {excel_line_numbers[position]}: {e_row} - Zeile: {new_row}"
+                log_messages.append(msg); print(f"!!! {msg}")
+
+    changelog = (
+        [(imported_at, "inserted", row[0], row[8], None, as_json(row)) for _, row in inserted]
+        + [(imported_at, "changed", new[0], new[8], as_json(old), as_json(new)) for _, old, new in diff["changed"]]
+        + [(imported_at, "removed", old[0], old[8], as_json(old), None) for _, old in diff["removed"]]
+    )
+    cur.executemany("""
+        INSERT INTO shortage_changelog (imported_at, change_type, Name, "Datum der Meldung", old_values, new_values)
+        VALUES (?, ?, ?, ?, ?, ?)""", changelog)
+    fill_shortage_derived_columns(cur)
+    return len(inserted)
+
+def log_drug_index_refresh(new_index, log_messages):
+    """ Protokolliert einen Neuaufbau durch refresh_drug_index_if_stale (None: nichts zu tun). """
+    if new_index:
+        log_messages.append(f"Tabelle asp geändert, Drug-Index auf Version {new_index.version} aktualisiert."); print(log_messages[-1])
+
+@timed("excel_import")
+def update_database_from_excel(db_path, excel_path, log_messages=None):
+    """
+    Liest die heruntergeladene Excel-Datei und gleicht die shortage-Tabelle ab:
+    nur neue, geänderte und entfernte Einträge werden geschrieben.
+    Ist der Export seit dem letzten Import unverändert (Datei- oder Zeilen-Hash),
+    wird nichts geschrieben und result = "unchanged" gemeldet.
+    Rückgabe: (Erfolg, Log-Meldungen, Zusammenfassung mit 'result' oder None).
+    """
+    if log_messages is None: log_messages = []
 
     if not os.path.exists(excel_path):
         msg = f"FEHLER: Excel-Datei '{os.path.basename(excel_path)}' nicht gefunden für DB Update."
         log_messages.append(msg)
         print(f"!!! {msg}")
-        return False, log_messages
+        return False, log_messages, None
 
     log_messages.append(f"Starte DB-Update aus Excel '{os.path.basename(excel_path)}'...")
     print(log_messages[-1])
 
-    conn = get_db()
+    conn = get_write_db() # wartet, falls gerade eine Migration schreibt
     if not conn:
         msg = "FEHLER: Konnte keine Datenbankverbindung herstellen für DB Update."
         log_messages.append(msg)
         print(f"!!! {msg}")
-        return False, log_messages
+        return False, log_messages, None
 
-    inserted_rows = 0
     try:
+        migrate_database(conn) # Abgeleitete Spalten, Changelog und Fingerabdrücke müssen existieren
         cur = conn.cursor()
+        stored_fingerprints = get_import_fingerprints(cur)
 
-        log_messages.append("Lösche alte Daten aus 'shortage'...")
-        print(log_messages[-1])
-        cur.execute("DELETE FROM shortage;")
+        # Byte-identischer Export wie beim letzten Import: gar nicht erst parsen
+        file_fingerprint = file_sha256(excel_path)
+        if stored_fingerprints.get('file_sha256') == file_fingerprint:
+            msg = f"Export unverändert seit dem letzten Import (SHA-256 {file_fingerprint[:12]}...), Import übersprungen."
+            log_messages.append(msg); print(msg)
+            log_drug_index_refresh(refresh_drug_index_if_stale(), log_messages) # asp kann sich trotzdem geändert haben
+            return True, log_messages, {"result": "unchanged", "file_sha256": file_fingerprint}
 
         log_messages.append(f"Lese Excel-Datei '{os.path.basename(excel_path)}'...")
         print(log_messages[-1])
@@ -249,145 +1327,217 @@ def update_database_from_excel(db_path, excel_path):
         log_messages.append(f"Gefundene Spalten im Excel: {list(df.columns)}")
         print(log_messages[-1])
 
-        # --- !!! HIER DAS MAPPING ANPASSEN AN DIE EXCEL-SPALTEN !!! ---
-        # Links: Interne Schlüssel (egal wie sie heißen)
-        # Rechts: Exakte Spaltenüberschriften aus deiner Excel-Datei!
-        col_map = {
-            'db_name': 'Name',
-            'db_verwendung': 'Verwendung',
-            'db_status': 'Status',
-            'db_details': 'Details', # Für die REAL-Spalte in der DB
-            'db_melder': 'Melder',
-            'db_pzn_nicht': 'PZN nicht verfügbarer Packungen',
-            'db_pzn_eingeschr': 'PZN eingeschränkt verfügbarer Packungen ', # Auf Tippfehler/Leerzeichen am Ende achten!
-            'db_pzn_wieder': 'PZN wieder verfügbarer Packungen ',
-            # 'ATC Code' wird ignoriert, da nicht in 'shortage'-Tabelle
-            'db_datum_meldung': 'Datum der Meldung',
-            'db_datum_aenderung': 'Datum der letzten Änderung'
-        }
+        col_map = SHORTAGE_COL_MAP
 
         # Überprüfe, ob die benötigten Quellspalten (die Werte im col_map) im DataFrame existieren
         missing_cols = [excel_col for excel_col in col_map.values() if excel_col not in df.columns]
         if missing_cols:
-             msg = f"FEHLER: Folgende Spalten fehlen in der Excel-Datei: {missing_cols}. Bitte col_map im Skript prüfen/anpassen."
+             msg = f"FEHLER: Folgende Spalten fehlen in der Excel-Datei: {missing_cols}. Bitte SHORTAGE_COL_MAP im Skript prüfen/anpassen."
              log_messages.append(msg)
              print(f"!!! {msg}")
-             conn.rollback()
-             return False, log_messages
+             return False, log_messages, None
 
-        log_messages.append("Füge neue Daten in Tabelle 'shortage' ein...")
-        print(log_messages[-1])
+        # Spaltenweise Normalisierung - noch ohne offene Schreibtransaktion
+        rows, excel_line_numbers, rejected_details = normalize_shortage_dataframe(df, col_map)
+        for line_number, med_name, details_val in rejected_details:
+            print(f"Warnung [Zeile {line_number}]: Konnte 'Details'-Wert '{details_val}' für '{med_name}' nicht in Zahl umwandeln. Setze auf NULL.")
+        if rejected_details:
+            msg = f"Warnung: {len(rejected_details)} 'Details'-Werte nicht in Zahl umwandelbar (auf NULL gesetzt), Zeilen: {[line for line, _, _ in rejected_details[:20]]}"
+            log_messages.append(msg); print(msg)
 
-        # Iteriere durch die Zeilen des DataFrames
-        for index, row in df.iterrows():
-            try:
-                # Extrahiere Daten mithilfe des Mappings
-                med_name = str(row[col_map['db_name']]).strip() if pd.notna(row[col_map['db_name']]) else ''
-                if not med_name: continue # Zeile ohne Namen überspringen
-
-                verwendung = str(row[col_map['db_verwendung']]).strip() if pd.notna(row[col_map['db_verwendung']]) else ''
-                status = str(row[col_map['db_status']]).strip() if pd.notna(row[col_map['db_status']]) else 'UNBEKANNT'
-
-                # Spezielle Behandlung für 'Details' (DB erwartet REAL = Zahl)
-                details_val = row[col_map['db_details']]
-                details_db = None # Standardwert NULL
-                if pd.notna(details_val):
-                    try:
-                        # Versuche, in eine Zahl umzuwandeln
-                        details_db = float(str(details_val).replace(',', '.')) # Komma durch Punkt ersetzen
-                    except (ValueError, TypeError):
-                        # Wenn Umwandlung fehlschlägt, logge Warnung, speichere NULL
-                        print(f"Warnung [Zeile {index+2}]: Konnte 'Details'-Wert '{details_val}' für '{med_name}' nicht in Zahl umwandeln. Setze auf NULL.")
-
-                melder = str(row[col_map['db_melder']]).strip() if pd.notna(row[col_map['db_melder']]) else ''
-                pzn_nicht = str(row[col_map['db_pzn_nicht']]).strip() if pd.notna(row[col_map['db_pzn_nicht']]) else ''
-                pzn_eingeschr = str(row[col_map['db_pzn_eingeschr']]).strip() if pd.notna(row[col_map['db_pzn_eingeschr']]) else ''
-                pzn_wieder = str(row[col_map['db_pzn_wieder']]).strip() if pd.notna(row[col_map['db_pzn_wieder']]) else ''
-                datum_meldung = str(row[col_map['db_datum_meldung']]).strip() if pd.notna(row[col_map['db_datum_meldung']]) else ''
-                datum_aenderung = str(row[col_map['db_datum_aenderung']]).strip() if pd.notna(row[col_map['db_datum_aenderung']]) else ''
-
-                # Query zum Einfügen in die 'shortage'-Tabelle
-                insert_query = """
-                    INSERT INTO shortage (
-                        Name, Verwendung, Status, Details, Melder,
-                        "PZN nicht verfügbarer Packungen",
-                        "PZN eingeschränkt verfügbarer Packungen ",
-                        "PZN wieder verfügbarer Packungen ",
-                        "Datum der Meldung", "Datum der letzten Änderung"
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                cur.execute(insert_query, (
-                    med_name, verwendung, status, details_db, melder,
-                    pzn_nicht, pzn_eingeschr, pzn_wieder,
-                    datum_meldung, datum_aenderung
-                ))
-                inserted_rows += 1
-
-            except KeyError as e:
-                msg = f"FEHLER in Excel Zeile {index+2}: Spaltenname '{e}' im Mapping nicht gefunden oder Zugriff fehlgeschlagen. Überspringe Zeile."
-                log_messages.append(msg); print(f"!!! {msg}")
-            except Exception as e_row:
-                msg = f"FEHLER in Excel Zeile {index+2}: {e_row} - Zeile: {row.to_dict()}"
-                log_messages.append(msg); print(f"!!! {msg}")
+        fingerprints = {'file_sha256': file_fingerprint, 'rows_sha256': rows_sha256(rows)}
+        if stored_fingerprints.get('rows_sha256') == fingerprints['rows_sha256']:
+            # Neue Datei, aber gleicher Inhalt: nur den Datei-Fingerabdruck nachziehen
+            store_import_fingerprints(cur, fingerprints)
+            conn.commit()
+            msg = "Inhalt des Exports unverändert seit dem letzten Import, keine Änderungen geschrieben."
+            log_messages.append(msg); print(msg)
+            log_drug_index_refresh(refresh_drug_index_if_stale(), log_messages)
+            return True, log_messages, {"result": "unchanged", "file_sha256": file_fingerprint}
 
+        log_messages.append("Vergleiche Export mit aktueller 'shortage'-Tabelle...")
+        print(log_messages[-1])
+        column_list = ", ".join(f'"{column}"' for column in SHORTAGE_DB_COLUMNS)
+        cur.execute("BEGIN IMMEDIATE") # Lesen + Delta-Schreiben atomar, Leser sehen bis zum Commit den alten Stand
+        existing_rows = [(row[0], tuple(row[1:])) for row in cur.execute(f"SELECT rowid, {column_list} FROM shortage ORDER BY rowid")]
+        diff = compute_shortage_diff(existing_rows, rows)
+        inserted_rows = apply_shortage_diff(cur, diff, excel_line_numbers, log_messages)
+        status_buckets, active_count = rebuild_active_shortage(cur)
+        rejected_rows = len(diff["inserted"]) - inserted_rows
+        if rejected_rows:
+            # Nicht als importiert merken, sonst würde derselbe Export beim nächsten Mal als "unverändert" übersprungen
+            cur.execute("DELETE FROM shortage_import_state")
+            msg = f"WARNUNG: {rejected_rows} Zeilen konnten nicht eingefügt werden; Fingerabdruck nicht gespeichert, der nächste Import versucht sie erneut."
+            log_messages.append(msg); print(msg)
+        else:
+            store_import_fingerprints(cur, fingerprints)
         conn.commit()
-        msg = f"Erfolgreich {inserted_rows} Datensätze aus Excel in 'shortage' eingefügt."
+
+        diff_counts = {
+            "result": "updated",
+            "inserted": inserted_rows,
+            "changed": len(diff["changed"]),
+            "removed": len(diff["removed"]),
+            "unchanged": diff["unchanged"],
+            "rejected": rejected_rows,
+            "status_buckets": status_buckets,
+            "active_shortages": active_count,
+            "file_sha256": file_fingerprint
+        }
+        msg = (f"Änderungen übernommen: {diff_counts['inserted']} neu, {diff_counts['changed']} geändert, "
+               f"{diff_counts['removed']} entfernt, {diff_counts['unchanged']} unverändert.")
         log_messages.append(msg); print(msg)
-        return True, log_messages
+        msg = f"Status der Meldungen: {', '.join(f'{status}: {count}' for status, count in status_buckets.items())} - {active_count} Medikamente mit aktivem Engpass."
+        log_messages.append(msg); print(msg)
+
+        # Neuen Schnappschuss erst nach dem Commit einspielen - und nur, wenn sich etwas geändert hat
+        if inserted_rows or diff["changed"] or diff["removed"]:
+            new_index = refresh_drug_index()
+            if new_index: msg = f"Drug-Index auf Version {new_index.version} aktualisiert."
+            else: msg = "WARNUNG: Drug-Index konnte nicht neu aufgebaut werden, alter Stand bleibt aktiv."
+            log_messages.append(msg); print(msg)
+        else:
+            log_drug_index_refresh(refresh_drug_index_if_stale(), log_messages)
+        return True, log_messages, diff_counts
 
     except FileNotFoundError:
         msg = f"FEHLER: Excel-Datei nicht gefunden unter: {excel_path}"
         log_messages.append(msg); print(f"!!! {msg}")
-        return False, log_messages
+        return False, log_messages, None
     except ImportError:
          msg = "FEHLER: Die 'pandas' oder 'openpyxl' Bibliothek fehlt. Bitte installieren: pip install pandas openpyxl"
          log_messages.append(msg); print(f"!!! {msg}")
-         return False, log_messages
+         return False, log_messages, None
     except Exception as e:
         msg = f"FEHLER während des DB-Updates aus Excel: {e}"
         log_messages.append(msg); print(f"!!! {msg}")
         try: conn.rollback()
         except: pass
-        return False, log_messages
+        return False, log_messages, None
     finally:
-        if conn: conn.close(); print("Datenbankverbindung geschlossen.")
+        release_write_db(); print("Schreib-Verbindung freigegeben.")
 
 
-# --- Route zum Auslösen des Downloads UND DB Updates ---
-@app.route('/update-database-auto', methods=['POST'])
-def trigger_download_and_update():
-    """ Löst Download via Selenium und anschließendes DB-Update aus Excel aus."""
-    print("\n--- [Auto Update] Anfrage zum Download & Update erhalten ---")
-    all_messages = []
+# --- Hintergrund-Job für Download UND DB Update ---
+UPDATE_JOB_HISTORY = 20 # So viele abgeschlossene Jobs bleiben abrufbar
 
-    # Schritt 1: Download versuchen
-    print("--- Schritt 1: Starte Download ---")
-    downloaded_file_path, download_logs = download_shortage_list()
-    all_messages.extend(download_logs)
+class UpdateJob:
+    """ Zustand eines Download-&-Update-Laufs; log_messages wächst während der Ausführung. """
+    def __init__(self):
+        self.job_id = str(uuid.uuid4())
+        self.status = "queued" # queued -> running -> success | error
+        self.message = "Update wartet auf Ausführung."
+        self.log_messages = []
+        self.diff = None
+        self.created_at = datetime.now().isoformat(timespec="seconds")
+        self.finished_at = None
 
-    # Schritt 2: Wenn Download erfolgreich, DB Update versuchen
-    if downloaded_file_path and os.path.exists(downloaded_file_path):
-        print("\n--- Schritt 2: Download erfolgreich, starte DB Update ---")
-        update_success, update_logs = update_database_from_excel(DATABASE_PATH, downloaded_file_path)
-        all_messages.extend(update_logs)
+    def to_dict(self, since=0):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "message": self.message,
+            "details": self.log_messages[since:],
+            "details_total": len(self.log_messages),
+            "result": self.diff["result"] if self.diff else None, # "updated" oder "unchanged"
+            "diff": self.diff,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
 
-        # Optional: Lösche die heruntergeladene Excel-Datei nach dem Update
-        try:
-            os.remove(downloaded_file_path)
-            print(f"Temporäre Excel-Datei '{os.path.basename(downloaded_file_path)}' gelöscht.")
-        except Exception as e_del:
-             print(f"Warnung: Konnte temporäre Excel-Datei nicht löschen: {e_del}")
+_update_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-update")
+_update_jobs = {} # job_id -> UpdateJob (Einfügereihenfolge = Startreihenfolge)
+_current_update_job = None
+_update_jobs_lock = threading.Lock()
+
+def run_download_and_update(job):
+    """ Führt Download via Selenium und anschließendes DB-Update aus Excel für einen Job aus. """
+    global _current_update_job
+    job.status = "running"
+    job.message = "Download und Datenbank-Update laufen..."
+    print(f"\n--- [Auto Update] Job {job.job_id} gestartet ---")
+    try:
+        # Schritt 1: Download versuchen
+        print("--- Schritt 1: Starte Download ---")
+        downloaded_file_path, _ = download_shortage_list(job.log_messages)
 
+        # Schritt 2: Wenn Download erfolgreich, DB Update versuchen
+        if downloaded_file_path and os.path.exists(downloaded_file_path):
+            print("\n--- Schritt 2: Download erfolgreich, starte DB Update ---")
+            update_success, _, diff_counts = update_database_from_excel(DATABASE_PATH, downloaded_file_path, job.log_messages)
+
+            # Optional: Lösche die heruntergeladene Excel-Datei nach dem Update
+            try:
+                os.remove(downloaded_file_path)
+                print(f"Temporäre Excel-Datei '{os.path.basename(downloaded_file_path)}' gelöscht.")
+            except Exception as e_del:
+                 print(f"Warnung: Konnte temporäre Excel-Datei nicht löschen: {e_del}")
 
-        if update_success:
-             print("--- [Auto Update] Gesamter Prozess erfolgreich abgeschlossen. ---")
-             return jsonify({"status": "success", "message": "Download und Datenbank-Update erfolgreich.", "details": all_messages}), 200
+            if update_success and diff_counts["result"] == "unchanged":
+                 print("--- [Auto Update] Export unverändert, nichts zu tun. ---")
+                 job.diff = diff_counts
+                 job.status, job.message = "success", "Download erfolgreich, Engpassliste unverändert."
+            elif update_success:
+                 print("--- [Auto Update] Gesamter Prozess erfolgreich abgeschlossen. ---")
+                 job.diff = diff_counts
+                 job.status, job.message = "success", "Download und Datenbank-Update erfolgreich."
+            else:
+                 print("--- [Auto Update] Prozess fehlgeschlagen (DB Update Fehler). ---")
+                 job.status, job.message = "error", "Download erfolgreich, aber Datenbank-Update fehlgeschlagen."
         else:
-             print("--- [Auto Update] Prozess fehlgeschlagen (DB Update Fehler). ---")
-             return jsonify({"status": "error", "message": "Download erfolgreich, aber Datenbank-Update fehlgeschlagen.", "details": all_messages}), 500
-    else:
-        print("--- [Auto Update] Prozess fehlgeschlagen (Download Fehler). ---")
-        return jsonify({"status": "error", "message": "Download der Datei fehlgeschlagen.", "details": all_messages}), 500
+            print("--- [Auto Update] Prozess fehlgeschlagen (Download Fehler). ---")
+            job.status, job.message = "error", "Download der Datei fehlgeschlagen."
+    except Exception as e:
+        msg = f"FEHLER: Unerwarteter Fehler im Update-Job: {e}"
+        job.log_messages.append(msg); print(f"!!! {msg}")
+        job.status, job.message = "error", "Update-Job mit unerwartetem Fehler abgebrochen."
+    finally:
+        job.finished_at = datetime.now().isoformat(timespec="seconds")
+        with _update_jobs_lock:
+            if _current_update_job is job: _current_update_job = None
+
+def start_update_job():
+    """
+    Startet einen neuen Update-Job oder liefert den bereits laufenden (Single-Flight),
+    damit nie zwei Browser gleichzeitig dieselbe Excel-Datei herunterladen.
+    Rückgabe: (Job, True wenn an bestehenden Job angehängt).
+    """
+    global _current_update_job
+    with _update_jobs_lock:
+        if _current_update_job is not None:
+            return _current_update_job, True
+        job = UpdateJob()
+        _update_jobs[job.job_id] = job
+        _current_update_job = job
+        # Alte, abgeschlossene Jobs verwerfen
+        finished = [job_id for job_id, old in _update_jobs.items() if old.finished_at]
+        for job_id in finished[:max(len(finished) - UPDATE_JOB_HISTORY, 0)]:
+            del _update_jobs[job_id]
+    _update_executor.submit(run_download_and_update, job)
+    return job, False
+
+
+# --- Route zum Auslösen des Downloads UND DB Updates ---
+@app.route('/update-database-auto', methods=['POST'])
+def trigger_download_and_update():
+    """ Stellt Download & DB-Update als Hintergrund-Job ein und antwortet sofort mit der Job-ID."""
+    print("\n--- [Auto Update] Anfrage zum Download & Update erhalten ---")
+    job, attached = start_update_job()
+    if attached: print(f"--- [Auto Update] Update läuft bereits, hänge an Job {job.job_id} an ---")
+    response = job.to_dict()
+    response["attached"] = attached
+    response["status_url"] = f"/update-database-auto/{job.job_id}"
+    return jsonify(response), 202
+
+
+@app.route('/update-database-auto/<job_id>')
+def get_update_job_status(job_id):
+    """ Liefert Status und bisherige Log-Meldungen eines Update-Jobs (ab ?since=N). """
+    job = _update_jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unbekannter Update-Job '{job_id}'."}), 404
+    since = request.args.get('since', 0, type=int)
+    return jsonify(job.to_dict(since=max(since, 0)))
 
 
 # --- Route für die Web-Oberfläche ---
@@ -397,30 +1547,203 @@ def index():
     return render_template('index.html')
 
 
+# --- Endpunkt für den Stand des In-Memory-Index ---
+@app.route('/drug-index/status')
+def drug_index_status():
+    """Zeigt, welcher Schnappschuss gerade Anfragen beantwortet."""
+    index = get_drug_index()
+    if index is None:
+        return jsonify({"status": "error", "message": "Drug-Index nicht verfügbar (DB-Fehler)."}), 503
+    return jsonify({
+        "status": "ok",
+        "version": index.version,
+        "built_at": index.built_at,
+        "medications": len(index.details_by_name),
+        "active_shortage_names": len(index.active_shortage_names),
+        "shortage_names": len(index.shortage_status_by_name),
+        "atc_nodes_per_level": index.atc_hierarchy.node_counts(),
+        "fuzzy_trigrams": len(index.fuzzy_index.postings),
+        "fuzzy_postings": index.fuzzy_index.total_postings
+    })
+
+
+# --- Endpunkt für Prometheus ---
+@app.route('/metrics')
+def metrics_endpoint():
+    """Latenz-Histogramme und Zähler im Prometheus-Textformat."""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # --- Endpunkt für Autocomplete ---
 @app.route('/autocomplete/medication')
 def autocomplete_medication():
-    """Liefert Medikamentennamen für Autocomplete."""
-    # (Code bleibt unverändert)
-    # [Code der Funktion hier einfügen...]
+    """
+    Liefert Medikamentennamen für Autocomplete.
+    mode=prefix (Standard): Liste von Namen mit passendem Anfang.
+    mode=fuzzy: Liste von {"name", "score"} für Teilstring-/Tippfehlertreffer.
+    """
     search_term = request.args.get('term', '')
+    mode = request.args.get('mode', 'prefix')
+    if mode not in ('prefix', 'fuzzy'):
+        return jsonify({"error": "'mode' muss 'prefix' oder 'fuzzy' sein."}), 400
     suggestions = []
     if search_term and len(search_term) > 1:
-        conn = get_db()
-        if conn:
-            try:
-                cur = conn.cursor()
-                query = "SELECT Name FROM asp WHERE Name LIKE ? LIMIT 15" # Limit 15
-                cur.execute(query, (search_term + '%',))
-                results = cur.fetchall()
-                suggestions = [row['Name'] for row in results]
-            except sqlite3.Error as e:
-                print(f"!!! Fehler bei Autocomplete-Abfrage für '{search_term}': {e}")
-            finally:
-                if conn: conn.close()
+        if mode == 'fuzzy':
+            suggestions = [{"name": name, "score": score} for name, score in fuzzy_search_names(search_term, limit=15)]
+        else:
+            suggestions = autocomplete_names(search_term, limit=15) # Limit 15
     return jsonify(suggestions)
 
 
+# --- CDS Hooks Client ---
+class CdsHookClient:
+    """
+    Sendet CDS-Hooks-Anfragen über eine Session mit Keep-Alive-Pool.
+    Ein Circuit Breaker öffnet nach CDS_BREAKER_FAILURE_THRESHOLD Fehlern in
+    Folge (Timeout, Verbindungsfehler, HTTP 5xx) und lässt erst nach
+    CDS_BREAKER_RESET_SECONDS wieder einen Probeaufruf durch. Aufrufe können
+    auch im Hintergrund laufen; das Ergebnis ist dann über die hookInstance abrufbar.
+    """
+    def __init__(self, pool_size, failure_threshold, reset_seconds):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="cds-hook")
+        self.results = OrderedDict() # hookInstance -> Ergebnis-Dict (None = läuft noch)
+
+    def allow_request(self):
+        """ Geschlossen: ja. Offen: nein, außer die Wartezeit ist um (genau ein Probeaufruf). """
+        with self.lock:
+            if self.opened_at is None: return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_result(self, failed):
+        with self.lock:
+            self.trial_in_progress = False
+            if failed:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= self.failure_threshold:
+                    if self.opened_at is None: print(f"!!! CDS Circuit Breaker geöffnet nach {self.consecutive_failures} Fehlern in Folge.")
+                    self.opened_at = time.monotonic()
+            else:
+                if self.opened_at is not None: print("CDS Circuit Breaker wieder geschlossen.")
+                self.consecutive_failures = 0
+                self.opened_at = None
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None: return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def send(self, payload, url=None):
+        """
+        Sendet den Hook synchron.
+        Rückgabe: {"target_url", "status_code", "error", "response_body"}.
+        """
+        url = url or EXTERNAL_CDS_HOOK_URL
+        result = {"target_url": url, "status_code": None, "error": None, "response_body": None}
+        if not self.allow_request():
+            metrics.increment(f"{METRICS_PREFIX}_cds_breaker_rejections_total", help_text="CDS Hooks, die wegen offenem Circuit Breaker nicht gesendet wurden")
+            result["error"] = f"Circuit Breaker offen: externer CDS-Service nach {self.consecutive_failures} Fehlern in Folge für {self.reset_seconds}s pausiert"
+            print(f"    FEHLER: {result['error']}")
+            return result
+        print(f"--- [Check & Notify] Sende STANDARD CDS Hook an externen Service ---"); print(f"    Ziel-URL: {url}")
+        response_data = None; response_text = None; failed = True # bis die Antwort da ist
+        try:
+            try:
+                with timing("cds_hook_post"):
+                    response = self.session.post(url, json=payload, timeout=CDS_HOOK_TIMEOUT_SECONDS)
+                result["status_code"] = response.status_code
+                failed = response.status_code >= 500
+                try: response_data = response.json()
+                except json.JSONDecodeError: print(f"    Antwort vom externen Service (Status {response.status_code}) war kein gültiges JSON."); response_text = response.text; response_data = None
+                response.raise_for_status(); print(f"    Erfolgreich gesendet. Antwort vom externen Service erhalten (Status {response.status_code}).")
+            except requests.exceptions.Timeout: error_msg = "Timeout beim Senden des Hooks"; print(f"    FEHLER: {error_msg} an {url}."); result["error"] = error_msg; failed = True
+            except requests.exceptions.HTTPError as e: error_msg = f"Fehler beim Senden/Verarbeiten des Hooks: {e}"; print(f"    FEHLER: {error_msg}"); result["error"] = str(e)
+            except requests.exceptions.RequestException as e: error_msg = f"Fehler beim Senden/Verarbeiten des Hooks: {e}"; print(f"    FEHLER: {error_msg}"); result["error"] = str(e); failed = True
+        finally:
+            self.record_result(failed) # auch bei unerwarteten Exceptions, sonst bleibt ein Probeaufruf hängen
+        result["response_body"] = response_data if response_data else response_text
+        return result
+
+    def send_async(self, payload, url=None):
+        """ Stellt den Hook in den Hintergrund-Pool ein; Ergebnis später über get_result(hookInstance). """
+        hook_instance = payload["hookInstance"]
+        with self.lock:
+            self.results[hook_instance] = None
+            while len(self.results) > CDS_HOOK_RESULT_HISTORY: self.results.popitem(last=False)
+        def run():
+            try:
+                result = self.send(payload, url)
+            except Exception as e:
+                print(f"!!! Unerwarteter Fehler beim CDS Hook {hook_instance}: {e}")
+                result = {"target_url": url or EXTERNAL_CDS_HOOK_URL, "status_code": None, "error": f"Unerwarteter Fehler: {e}", "response_body": None}
+            with self.lock:
+                if hook_instance in self.results: self.results[hook_instance] = result
+        self.executor.submit(run)
+        return hook_instance
+
+    def get_result(self, hook_instance):
+        """ Rückgabe: (bekannt?, Ergebnis oder None solange der Aufruf läuft). """
+        with self.lock:
+            if hook_instance not in self.results: return False, None
+            return True, self.results[hook_instance]
+
+cds_hook_client = CdsHookClient(CDS_HOOK_POOL_SIZE, CDS_BREAKER_FAILURE_THRESHOLD, CDS_BREAKER_RESET_SECONDS)
+
+def build_cds_hook_payload(medications):
+    """
+    Baut einen order-sign CDS-Hooks-Request. medications: Liste von (Name, ATC-Code oder None);
+    jedes Medikament wird eine MedicationRequest im draftOrders-Bundle.
+    """
+    hook_instance_id = str(uuid.uuid4()); hook_type = "order-sign"
+    entries = []
+    for med_name, atc_code in medications:
+        medication_request_resource = {"resourceType": "MedicationRequest","id": f"medreq-{uuid.uuid4()}","status": "draft","intent": "order","medicationCodeableConcept": { "text": med_name },"subject": { "reference": "Patient/example-patient-1" }};
+        if atc_code: medication_request_resource["medicationCodeableConcept"]["coding"] = [{"system": "http://fhir.hl7.org/CodeSystem/v3-atc", "code": atc_code}]
+        entries.append({ "resource": medication_request_resource })
+    draft_orders_bundle = {"resourceType": "Bundle","entry": entries};
+    return {"hookInstance": hook_instance_id,"hook": hook_type,"context": {"userId": "Practitioner/example-practitioner-1","patientId": "Patient/example-patient-1","draftOrders": draft_orders_bundle}};
+
+
+def dispatch_cds_hook(payload, async_hook=False):
+    """
+    Sendet den Hook synchron oder (async_hook) im Hintergrund.
+    Rückgabe: Dict für 'external_cds_hook_call' in der Antwort.
+    """
+    hook_instance_id = payload["hookInstance"]
+    if async_hook:
+        # Lokales Ergebnis sofort liefern, Hook läuft im Hintergrund weiter
+        cds_hook_client.send_async(payload)
+        external_call = {"target_url": EXTERNAL_CDS_HOOK_URL, "status": "pending", "hook_instance": hook_instance_id, "result_url": f"/cds-hook-results/{hook_instance_id}"}
+    else:
+        external_call = dict(cds_hook_client.send(payload), hook_instance=hook_instance_id)
+    external_call["circuit_breaker"] = cds_hook_client.state()
+    return external_call
+
+
+@app.route('/cds-hook-results/<hook_instance>')
+def get_cds_hook_result(hook_instance):
+    """ Liefert das Ergebnis eines im Hintergrund gesendeten CDS Hooks. """
+    known, result = cds_hook_client.get_result(hook_instance)
+    if not known:
+        return jsonify({"error": f"Unbekannte hookInstance '{hook_instance}'."}), 404
+    if result is None:
+        return jsonify({"hook_instance": hook_instance, "status": "pending"}), 202
+    return jsonify(dict(result, hook_instance=hook_instance, status="done"))
+
+
 # --- Endpunkt für die Prüfung + Externen Hook ---
 @app.route('/check-and-notify-external', methods=['POST'])
 def check_and_notify_external_cds_service():
@@ -439,24 +1762,83 @@ def check_and_notify_external_cds_service():
             alt_result = find_alternatives(atc_code, med_name)
             if alt_result is not None: alternatives = alt_result
             else: print("!!! Fehler bei lokaler Alternativensuche.")
-    print(f"Lokaler Status: '{local_status_text}', ATC: {atc_code}, Alternativen gefunden: {len(alternatives)}")
-    hook_instance_id = str(uuid.uuid4()); hook_type = "order-sign"
-    medication_request_resource = {"resourceType": "MedicationRequest","id": f"medreq-{uuid.uuid4()}","status": "draft","intent": "order","medicationCodeableConcept": { "text": med_name },"subject": { "reference": "Patient/example-patient-1" }};
-    if atc_code: medication_request_resource["medicationCodeableConcept"]["coding"] = [{"system": "http://fhir.hl7.org/CodeSystem/v3-atc", "code": atc_code}]
-    draft_orders_bundle = {"resourceType": "Bundle","entry": [{ "resource": medication_request_resource }]};
-    external_hook_payload = {"hookInstance": hook_instance_id,"hook": hook_type,"context": {"userId": "Practitioner/example-practitioner-1","patientId": "Patient/example-patient-1","draftOrders": draft_orders_bundle}};
-    print(f"--- [Check & Notify] Sende STANDARD CDS Hook an externen Service ---"); print(f"    Ziel-URL: {EXTERNAL_CDS_HOOK_URL}")
-    response_from_external_service_data = None; external_call_error = None; external_call_status_code = None; response_text = None
-    try:
-        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}; response = requests.post( EXTERNAL_CDS_HOOK_URL, headers=headers, json=external_hook_payload, timeout=20)
-        external_call_status_code = response.status_code
-        try: response_from_external_service_data = response.json()
-        except json.JSONDecodeError: print(f"    Antwort vom externen Service (Status {external_call_status_code}) war kein gültiges JSON."); response_text = response.text; response_from_external_service_data = None
-        response.raise_for_status(); print(f"    Erfolgreich gesendet. Antwort vom externen Service erhalten (Status {external_call_status_code}).")
-    except requests.exceptions.Timeout: error_msg = "Timeout beim Senden des Hooks"; print(f"    FEHLER: {error_msg} an {EXTERNAL_CDS_HOOK_URL}."); external_call_error = error_msg
-    except requests.exceptions.RequestException as e: error_msg = f"Fehler beim Senden/Verarbeiten des Hooks: {e}"; print(f"    FEHLER: {error_msg}"); external_call_error = str(e)
+    shortage_status_raw = get_shortage_status(med_name)
+    print(f"Lokaler Status: '{local_status_text}' (BASG-Status: {shortage_status_raw}), ATC: {atc_code}, Alternativen gefunden: {len(alternatives)}")
+    external_hook_payload = build_cds_hook_payload([(med_name, atc_code)])
+    external_call = dispatch_cds_hook(external_hook_payload, request_data.get('async_hook'))
     print("--- [Check & Notify] Vorgang abgeschlossen ---")
-    final_response = {"medication_checked": med_name,"local_check": {"status": local_status_text,"atc_code_found": atc_code,"alternatives_found_count": len(alternatives),"alternatives_details": alternatives},"external_cds_hook_call": {"target_url": EXTERNAL_CDS_HOOK_URL,"status_code": external_call_status_code,"error": external_call_error,"response_body": response_from_external_service_data if response_from_external_service_data else response_text }}; return jsonify(final_response)
+    final_response = {"medication_checked": med_name,"local_check": {"status": local_status_text,"shortage_status_raw": shortage_status_raw,"shortage_active": is_shortage,"atc_code_found": atc_code,"alternatives_found_count": len(alternatives),"alternatives_details": alternatives},"external_cds_hook_call": external_call}
+    if wants_debug_timings(): final_response["timings"] = timings_breakdown()
+    return jsonify(final_response)
+
+
+# --- Batch-Prüfung ganzer Medikationslisten ---
+MAX_BATCH_SIZE = 5000
+
+@timed("check_medications_batch")
+def check_medications_batch(med_names):
+    """
+    Prüft viele Medikamente gegen einen einzigen Drug-Index-Schnappschuss.
+    Verfügbare Mitglieder eines ATC-Knotens werden nur einmal bestimmt, auch
+    wenn mehrere Medikamente der Liste in derselben Gruppe liegen.
+    Rückgabe: (Liste der Ergebnisse in Eingabereihenfolge, Anzahl ATC-Gruppen) oder None bei DB-Fehler.
+    """
+    index = get_drug_index()
+    if index is None: return None
+    group_cache = {} # ATC-Knoten -> verfügbare Mitglieder, geteilt über die ganze Liste
+    results_by_name = {}
+    for med_name in med_names:
+        if med_name in results_by_name: continue
+        is_shortage = med_name in index.active_shortage_names
+        med_details = index.details_by_name.get(med_name)
+        atc_code = med_details.get("ATC_Code") if med_details else None
+        alternatives = []
+        if is_shortage and atc_code:
+            alternatives = find_alternatives(atc_code, med_name, group_cache=group_cache, index=index) or []
+        results_by_name[med_name] = {
+            "medication_checked": med_name,
+            "status": "Engpass (lokal)" if is_shortage else "Verfügbar (lokal)",
+            "shortage_status_raw": index.shortage_status_by_name.get(med_name),
+            "shortage_active": is_shortage,
+            "atc_code_found": atc_code,
+            "alternatives_found_count": len(alternatives),
+            "alternatives_details": alternatives
+        }
+    return [results_by_name[med_name] for med_name in med_names], len(group_cache)
+
+
+@app.route('/check-batch', methods=['POST'])
+def check_batch():
+    """
+    Prüft eine ganze Medikationsliste in einem Aufruf.
+    JSON: {"medication_names": [...], "send_cds_hook": false, "async_hook": false}
+    Mit send_cds_hook wird EIN CDS Hook gesendet, dessen draftOrders alle Medikamente enthält.
+    """
+    request_data = request.json
+    if not isinstance(request_data, dict) or not isinstance(request_data.get('medication_names'), list): return jsonify({"error": "Bitte 'medication_names' als Liste im JSON Body angeben."}), 400
+    med_names = [str(name).strip() for name in request_data['medication_names'] if name is not None and str(name).strip()]
+    if not med_names: return jsonify({"error": "'medication_names' darf nicht leer sein."}), 400
+    if len(med_names) > MAX_BATCH_SIZE: return jsonify({"error": f"Maximal {MAX_BATCH_SIZE} Medikamente pro Batch."}), 400
+    print(f"\n--- [Check Batch] Lokale Prüfung für {len(med_names)} Medikamente gestartet ---")
+    batch_result = check_medications_batch(med_names)
+    if batch_result is None: return jsonify({"error": "DB Fehler bei lokaler Prüfung"}), 500
+    results, atc_group_count = batch_result
+    external_call = None
+    if request_data.get('send_cds_hook'):
+        unique_results = {result["medication_checked"]: result for result in results}.values()
+        external_hook_payload = build_cds_hook_payload([(result["medication_checked"], result["atc_code_found"]) for result in unique_results])
+        external_call = dispatch_cds_hook(external_hook_payload, request_data.get('async_hook'))
+    shortage_count = sum(1 for result in results if result["status"] == "Engpass (lokal)")
+    print(f"--- [Check Batch] Abgeschlossen: {shortage_count} Engpässe, {atc_group_count} ATC-Gruppen durchsucht ---")
+    response = {
+        "medications_checked": len(results),
+        "shortages_found": shortage_count,
+        "atc_groups_searched": atc_group_count,
+        "results": results,
+        "external_cds_hook_call": external_call
+    }
+    if wants_debug_timings(): response["timings"] = timings_breakdown()
+    return jsonify(response)
 
 
 # --- Hauptausführung (Startet den Flask Server) ---
@@ -465,6 +1847,13 @@ if __name__ == '__main__':
     print(f"Datenbank erwartet unter: {DATABASE_PATH}")
     if not os.path.exists(DATABASE_PATH):
         print(f"!!! WARNUNG: Datenbankdatei nicht gefunden: {DATABASE_PATH} !!!")
+    else:
+        try:
+            migrate_with_write_db()
+            print(f"Datenbank-Schema auf Version {get_schema_version(get_db())}, journal_mode {get_db_pool().journal_mode}.")
+        except sqlite3.Error as e:
+            print(f"!!! Schema-Migration fehlgeschlagen: {e}")
+        refresh_drug_index() # Schnappschuss vor der ersten Anfrage aufbauen
     print(f"Externer CDS Hook wird gesendet an: {EXTERNAL_CDS_HOOK_URL}")
     print(f"Automatischer Download von: {BASG_PAGE_URL}")
     print(f"Erwartete Downloaddatei: {EXPECTED_DOWNLOAD_FILENAME} in {DOWNLOAD_DIR}")
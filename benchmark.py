@@ -0,0 +1,571 @@
+# Benchmarks für die Abfragepfade in app.py
+# Aufruf: python benchmark.py [--asp-rows 50000] [--shortage-ratio 0.1]
+#         python benchmark.py --suite requests --json ergebnis.json  (Anfragepfad, vergleichbar zwischen Commits)
+import argparse
+import contextlib
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app
+
+
+# --- Synthetische Testdaten ---
+ATC_LEVEL1 = "ABCDGHJLMNPRSV"
+SUBSTANCES = ["Ibuprofen", "Paracetamol", "Diclofenac", "Metamizol", "Amoxicillin", "Ramipril", "Bisoprolol",
+              "Metformin", "Simvastatin", "Pantoprazol", "Omeprazol", "Levothyroxin", "Amlodipin", "Candesartan",
+              "Sertralin", "Escitalopram", "Tramadol", "Clopidogrel", "Salbutamol", "Cetirizin", "Mirtazapin",
+              "Quetiapin", "Valsartan", "Torasemid", "Allopurinol", "Doxycyclin", "Prednisolon", "Enalapril"]
+BRANDS = ["ratiopharm", "Genericon", "1A Pharma", "Hexal", "Sandoz", "Stada", "Krka", "Actavis", "Arcana"]
+FORMS = ["Filmtabletten", "Brausetabletten", "Lösung zum Einnehmen", "Zäpfchen", "Tropfen", "Hartkapseln",
+         "Retardtabletten", "Schmelztabletten"]
+
+
+def random_atc_code(rng):
+    """ Erzeugt einen plausiblen 7-stelligen ATC-Code (z.B. N02BE01). """
+    return (rng.choice(ATC_LEVEL1) + f"{rng.randint(1, 16):02d}"
+            + rng.choice("ABCDEFGHX") + rng.choice("ABCDEFGHX")
+            + f"{rng.randint(1, 20):02d}")
+
+
+def create_synthetic_db(db_path, asp_rows=50000, shortage_ratio=0.1, seed=42, atc_group_size=40, atc_skew=0.0):
+    """
+    Legt eine drug.db mit asp- und shortage-Tabelle und Zufallsdaten an.
+    atc_group_size: mittlere Anzahl Medikamente je ATC-Code.
+    atc_skew: 0 = Codes gleich häufig, > 0 = Zipf-artig (wenige sehr große Gruppen).
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS asp")
+    cur.execute("DROP TABLE IF EXISTS shortage")
+    cur.execute("CREATE TABLE asp (Name TEXT PRIMARY KEY, ATC_Code TEXT, Zulassungsnummer TEXT, Verwendung TEXT)")
+    cur.execute("""
+        CREATE TABLE shortage (
+            Name TEXT, Verwendung TEXT, Status TEXT, Details REAL, Melder TEXT,
+            "PZN nicht verfügbarer Packungen" TEXT,
+            "PZN eingeschränkt verfügbarer Packungen " TEXT,
+            "PZN wieder verfügbarer Packungen " TEXT,
+            "Datum der Meldung" TEXT, "Datum der letzten Änderung" TEXT
+        )""")
+    # Wenige ATC-Gruppen mit vielen Mitgliedern, wie in der echten ASP-Liste
+    atc_codes = [random_atc_code(rng) for _ in range(max(asp_rows // atc_group_size, 1))]
+    if atc_skew > 0:
+        cum_weights = list(itertools.accumulate(1 / (rank + 1) ** atc_skew for rank in range(len(atc_codes))))
+        pick_atc_code = lambda: rng.choices(atc_codes, cum_weights=cum_weights)[0]
+    else:
+        pick_atc_code = lambda: rng.choice(atc_codes)
+    asp_data = []
+    seen_names = set()
+    for _ in range(asp_rows):
+        name = f"{rng.choice(SUBSTANCES)} {rng.choice(BRANDS)} {rng.choice([5, 10, 20, 40, 100, 400])} mg {rng.choice(FORMS)}"
+        # Name ist Primärschlüssel: Dubletten wie in der ASP-Liste über die Packung unterscheiden
+        variant = 1
+        unique_name = name
+        while unique_name in seen_names:
+            variant += 1
+            unique_name = f"{name} - Packung {variant}"
+        seen_names.add(unique_name)
+        asp_data.append((unique_name, pick_atc_code(), f"{rng.randint(1, 99)}-{rng.randint(10000, 99999)}", "Human"))
+    cur.executemany("INSERT INTO asp VALUES (?, ?, ?, ?)", asp_data)
+    shortage_data = [
+        (row[0], "Human", rng.choice(["AKTIV", "BEENDET"]), None, "Zulassungsinhaber", "", "", "", "01.01.2025", "01.02.2025")
+        for row in asp_data if rng.random() < shortage_ratio
+    ]
+    cur.executemany("INSERT INTO shortage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", shortage_data)
+    conn.commit()
+    conn.close()
+    return [row[0] for row in asp_data], [row[1] for row in asp_data]
+
+
+def create_synthetic_shortage_frame(names, rows=100000, seed=42):
+    """
+    Erzeugt einen DataFrame im Format des BASG-Exports (Spalten laut
+    app.SHORTAGE_COL_MAP), inklusive typischer Unsauberkeiten: Leerzeichen,
+    fehlende Werte, Dezimalkomma und nicht numerische 'Details'.
+    """
+    import pandas as pd
+    rng = random.Random(seed)
+    col = app.SHORTAGE_COL_MAP
+    data = {excel_col: [] for excel_col in col.values()}
+    for i in range(rows):
+        data[col['db_name']].append(rng.choice(names) + (" " if i % 7 == 0 else "") if i % 50 else None)
+        data[col['db_verwendung']].append(rng.choice(["Human", "Veterinär", None]))
+        data[col['db_status']].append(rng.choice(["AKTIV", "BEENDET", " AKTIV ", None]))
+        data[col['db_details']].append(rng.choice([None, 1.5, "2,5", "3", "siehe Fachinfo", 4]))
+        data[col['db_melder']].append(rng.choice(["Zulassungsinhaber", "Großhandel", None]))
+        data[col['db_pzn_nicht']].append(rng.choice([f"{rng.randint(1000000, 9999999)}", None]))
+        data[col['db_pzn_eingeschr']].append(rng.choice([f"{rng.randint(1000000, 9999999)}", None]))
+        data[col['db_pzn_wieder']].append(None)
+        data[col['db_datum_meldung']].append(f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2025")
+        data[col['db_datum_aenderung']].append(rng.choice([f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2025", None]))
+    return pd.DataFrame(data)
+
+
+# --- Alte Implementierung als Vergleichsbasis ---
+def connect_unpooled():
+    """ Neue Verbindung wie im ursprünglichen get_db (ohne Pool). """
+    conn = sqlite3.connect(app.DATABASE_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def check_shortage_sqlite(name):
+    """ check_shortage per SQL: eigene Verbindung und Abfrage pro Name. """
+    conn = connect_unpooled()
+    try:
+        return conn.execute(app.SQL_ACTIVE_SHORTAGE_BY_NAME, (name,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def find_alternatives_n_plus_one(atc_code, original_name):
+    """ Ursprünglicher Pfad: Kandidaten per LIKE laden, dann check_shortage pro Kandidat. """
+    conn = connect_unpooled()
+    cur = conn.cursor()
+    cur.execute(app.SQL_ASP_BY_ATC_PREFIX, (atc_code[:-2] + "%", original_name))
+    potential_alternatives = [dict(row) for row in cur.fetchall()]
+    conn.close()
+    return [alt for alt in potential_alternatives if alt.get("Name") and not check_shortage_sqlite(alt["Name"])]
+
+
+def autocomplete_sqlite_like(search_term):
+    """ Ursprünglicher Autocomplete-Pfad: neue Verbindung + LIKE-Scan pro Tastendruck. """
+    conn = connect_unpooled()
+    try:
+        rows = conn.execute(app.SQL_ASP_NAME_PREFIX, (search_term + '%',)).fetchall()
+        return [row['Name'] for row in rows]
+    finally:
+        conn.close()
+
+
+def import_rows_iterrows(conn, df):
+    """ Ursprünglicher Import: df.iterrows() mit einem INSERT pro Zeile. """
+    import pandas as pd
+    col_map = app.SHORTAGE_COL_MAP
+    cur = conn.cursor()
+    cur.execute("DELETE FROM shortage;")
+    inserted_rows = 0
+    for index, row in df.iterrows():
+        med_name = str(row[col_map['db_name']]).strip() if pd.notna(row[col_map['db_name']]) else ''
+        if not med_name: continue
+        verwendung = str(row[col_map['db_verwendung']]).strip() if pd.notna(row[col_map['db_verwendung']]) else ''
+        status = str(row[col_map['db_status']]).strip() if pd.notna(row[col_map['db_status']]) else 'UNBEKANNT'
+        details_val = row[col_map['db_details']]
+        details_db = None
+        if pd.notna(details_val):
+            try: details_db = float(str(details_val).replace(',', '.'))
+            except (ValueError, TypeError): pass
+        other = [str(row[col_map[key]]).strip() if pd.notna(row[col_map[key]]) else ''
+                 for key in ('db_melder', 'db_pzn_nicht', 'db_pzn_eingeschr', 'db_pzn_wieder', 'db_datum_meldung', 'db_datum_aenderung')]
+        cur.execute(app.SHORTAGE_INSERT_QUERY, (med_name, verwendung, status, details_db, *other))
+        inserted_rows += 1
+    conn.commit()
+    return inserted_rows
+
+
+def import_rows_vectorized(conn, df):
+    """ Neuer Import: spaltenweise Normalisierung + ein executemany. """
+    rows, _, _ = app.normalize_shortage_dataframe(df, app.SHORTAGE_COL_MAP)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM shortage;")
+    cur.executemany(app.SHORTAGE_INSERT_QUERY, rows)
+    conn.commit()
+    return len(rows)
+
+
+def time_calls(func, args_list):
+    """ Führt func für alle Argumente aus und liefert (Sekunden gesamt, Ergebnisse). """
+    results = []
+    start = time.perf_counter()
+    for args in args_list:
+        results.append(func(*args))
+    return time.perf_counter() - start, results
+
+
+def bench_find_alternatives(names, atc_codes, samples, rng):
+    """ Vergleicht den ursprünglichen N+1-Pfad mit app.find_alternatives auf denselben Stichproben. """
+    picks = [rng.randrange(len(names)) for _ in range(samples)]
+    args_list = [(atc_codes[i], names[i]) for i in picks]
+    old_seconds, old_results = time_calls(find_alternatives_n_plus_one, args_list)
+    new_seconds, new_results = time_calls(app.find_alternatives, args_list)
+    # Der alte Pfad entspricht Ebene 4 (chemische Untergruppe) der hierarchischen Suche
+    for old, new in zip(old_results, new_results):
+        if sorted(alt["Name"] for alt in old) != sorted(alt["Name"] for alt in new if alt["ATC_Level"] >= 4):
+            raise SystemExit("!!! Ergebnisse von altem und neuem Pfad unterscheiden sich!")
+    print(f"find_alternatives ({samples} Aufrufe, Ø {sum(len(r) for r in new_results) / samples:.0f} Alternativen)")
+    print(f"    N+1 (check_shortage pro Kandidat): {old_seconds * 1000 / samples:8.2f} ms/Aufruf")
+    print(f"    Drug-Index (In-Memory):            {new_seconds * 1000 / samples:8.2f} ms/Aufruf")
+    print(f"    Faktor: {old_seconds / new_seconds:.1f}x")
+
+
+def atc_like_query(prefix):
+    """ Ursprüngliche Gruppensuche: LIKE-Scan über asp mit neuer Verbindung. """
+    conn = connect_unpooled()
+    try:
+        return [row["Name"] for row in conn.execute("SELECT Name FROM asp WHERE ATC_Code LIKE ?", (prefix + "%",))]
+    finally:
+        conn.close()
+
+
+def bench_atc_levels(atc_codes, samples, rng):
+    """ Vergleicht LIKE-Abfrage und AtcHierarchy-Lookup für jede ATC-Ebene. """
+    hierarchy = app.get_drug_index().atc_hierarchy
+    print(f"ATC-Ebenen ({samples} Codes pro Ebene)")
+    for level, length in sorted(app.ATC_LEVEL_PREFIX_LENGTHS.items()):
+        prefixes = [(rng.choice(atc_codes)[:length],) for _ in range(samples)]
+        like_seconds, like_results = time_calls(atc_like_query, prefixes)
+        tree_seconds, tree_results = time_calls(lambda prefix: [alt["Name"] for alt in hierarchy.level_members(prefix)], prefixes)
+        if [sorted(r) for r in like_results] != [sorted(r) for r in tree_results]: # Index liefert in ATC-Reihenfolge
+            raise SystemExit(f"!!! LIKE und ATC-Hierarchie liefern auf Ebene {level} unterschiedliche Mitglieder!")
+        members = sum(len(result) for result in tree_results) / samples
+        print(f"    Ebene {level} (Ø {members:7.0f} Mitglieder): LIKE {like_seconds * 1000 / samples:7.2f} ms, Hierarchie {tree_seconds * 1e6 / samples:7.1f} µs")
+
+
+def print_query_plans(db_path):
+    """ Spielt die Schema-Migrationen ein und zeigt die Pläne der Nachschlage-Abfragen (geprüft in tests/test_migrations.py). """
+    conn = sqlite3.connect(db_path)
+    try:
+        applied = app.migrate_database(conn)
+        print(f"    Migrationen {applied} eingespielt, Schema-Version {app.get_schema_version(conn)}")
+        for label, (query, params) in app.LOOKUP_QUERIES.items():
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+            print(f"    {label + ':':32s} {'; '.join(plan)}")
+    finally:
+        conn.close()
+
+
+def keystroke_trace(names, typed_names, rng):
+    """ Simuliert Eingaben im GUI: jeder Name wird Zeichen für Zeichen (ab 2 Zeichen) getippt. """
+    trace = []
+    for _ in range(typed_names):
+        name = rng.choice(names)
+        # Mal Kleinschreibung, mal ohne Umlaute - wie Benutzer tatsächlich tippen
+        typed = rng.choice([name, name.lower(), name.replace("ä", "a")])
+        trace.extend((typed[:length],) for length in range(2, min(len(typed), 14) + 1))
+    return trace
+
+
+def bench_autocomplete(names, typed_names, rng):
+    """ Spielt einen Tastendruck-Trace gegen SQLite-LIKE und den Autocomplete-Index ab. """
+    trace = keystroke_trace(names, typed_names, rng)
+    old_seconds, _ = time_calls(autocomplete_sqlite_like, trace)
+    new_seconds, new_results = time_calls(app.autocomplete_names, trace)
+    hits = sum(1 for result in new_results if result)
+    print(f"autocomplete ({len(trace)} Tastendrücke, {hits} mit Vorschlägen)")
+    print(f"    SQLite LIKE (neue Verbindung):     {old_seconds * 1e6 / len(trace):8.1f} µs/Tastendruck")
+    print(f"    Sortiertes Array + bisect:         {new_seconds * 1e6 / len(trace):8.1f} µs/Tastendruck")
+    print(f"    Faktor: {old_seconds / new_seconds:.1f}x")
+
+
+def typo_query(name, rng):
+    """ Erzeugt eine realistische Fehleingabe: Tippfehler oder Wortfragment aus dem Namen. """
+    words = name.split()
+    word = rng.choice(words[:2])
+    kind = rng.choice(["drop", "swap", "fragment", "two_words"])
+    if kind == "drop" and len(word) > 4:
+        pos = rng.randrange(1, len(word))
+        return word[:pos] + word[pos + 1:]
+    if kind == "swap" and len(word) > 4:
+        pos = rng.randrange(1, len(word) - 1)
+        return word[:pos] + word[pos + 1] + word[pos] + word[pos + 2:]
+    if kind == "two_words":
+        return f"{words[1]} {words[0][:3]}"
+    return word[1:6]
+
+
+def bench_fuzzy(names, queries, rng):
+    """ Misst die Trigramm-Suche (mode=fuzzy) mit Tippfehlern und Teilstrings. """
+    trace = [(typo_query(rng.choice(names), rng),) for _ in range(queries)]
+    seconds, results = time_calls(app.fuzzy_search_names, trace)
+    latencies = []
+    for args in trace:
+        start = time.perf_counter()
+        app.fuzzy_search_names(*args)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    fuzzy_index = app.get_drug_index().fuzzy_index
+    print(f"fuzzy ({queries} Suchbegriffe, {sum(1 for r in results if r)} mit Treffern)")
+    print(f"    Trigramme: {len(fuzzy_index.postings)} behalten, {len(fuzzy_index.dropped_trigrams)} verworfen, {fuzzy_index.total_postings} Postings")
+    print(f"    Ø {seconds * 1000 / queries:.2f} ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+
+
+def bench_batch(names, batch_size, batches, rng):
+    """ Lasttest für /check-batch über den Flask-Testclient (ohne CDS Hook). """
+    client = app.app.test_client()
+    payloads = [{"medication_names": [rng.choice(names) for _ in range(batch_size)]} for _ in range(batches)]
+    latencies = []
+    shortages = 0
+    for payload in payloads:
+        start = time.perf_counter()
+        response = client.post('/check-batch', json=payload)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise SystemExit(f"!!! /check-batch antwortete mit {response.status_code}: {response.get_json()}")
+        shortages += response.get_json()["shortages_found"]
+    total = sum(latencies)
+    print(f"check-batch ({batches} Batches à {batch_size} Medikamente, {shortages} Engpässe)")
+    print(f"    {batches / total:8.1f} Batches/s, {batches * batch_size / total:10.0f} Medikamente/s, Ø {total * 1000 / batches:.1f} ms/Batch, max {max(latencies) * 1000:.1f} ms")
+
+
+def bench_import(db_path, names, rows, seed):
+    """ Vergleicht iterrows-Import und vektorisierten Bulk-Import (Zeilen/Sekunde). """
+    df = create_synthetic_shortage_frame(names, rows, seed)
+    conn = sqlite3.connect(db_path)
+    results = {}
+    for label, func in [("iterrows + INSERT pro Zeile", import_rows_iterrows), ("vektorisiert + executemany", import_rows_vectorized)]:
+        start = time.perf_counter()
+        inserted = func(conn, df)
+        seconds = time.perf_counter() - start
+        results[label] = conn.execute("SELECT * FROM shortage ORDER BY rowid").fetchall()
+        print(f"    {label + ':':35s} {inserted / seconds:10.0f} Zeilen/s ({seconds:.2f}s für {inserted} Zeilen)")
+    conn.close()
+    old_rows, new_rows = results.values()
+    if old_rows != new_rows:
+        raise SystemExit("!!! Importierte Daten von altem und neuem Pfad unterscheiden sich!")
+
+
+# --- Gesamter Anfragepfad über den Flask-Test-Client ---
+def write_synthetic_basg_export(path, names, rows, seed):
+    """ Schreibt einen synthetischen BASG-Export (Vertriebseinschraenkungen.xlsx) nach path. """
+    create_synthetic_shortage_frame(names, rows, seed).to_excel(path, index=False)
+    return path
+
+
+def start_cds_stub(latency_ms=0.0):
+    """ Lokaler Ersatz für den externen CDS-Service: antwortet auf jeden POST mit leeren Cards. """
+    class CdsStubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.server.received.append(self.path)
+            if latency_ms: time.sleep(latency_ms / 1000)
+            body = json.dumps({"cards": []}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CdsStubHandler)
+    server.received = [] # Pfade der eingegangenen Hooks (list.append ist threadsicher)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/cds-services/EngpassMed"
+
+
+def percentile(sorted_values, fraction):
+    """ Perzentil nach Nearest-Rank auf einer sortierten Liste. """
+    if not sorted_values: return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+
+def latency_summary(latencies, errors, wall_seconds):
+    """ Durchsatz und Latenz-Perzentile (ms) einer Messreihe. """
+    ordered = sorted(latencies)
+    as_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_per_s": round(len(ordered) / wall_seconds, 1) if wall_seconds else None,
+        "mean_ms": as_ms(sum(ordered) / len(ordered)) if ordered else None,
+        "p50_ms": as_ms(percentile(ordered, 0.50)),
+        "p95_ms": as_ms(percentile(ordered, 0.95)),
+        "p99_ms": as_ms(percentile(ordered, 0.99)),
+        "max_ms": as_ms(ordered[-1] if ordered else None)
+    }
+
+
+def run_scenario(client, make_request, count, warmup, clients, rng):
+    """
+    Schickt `count` Anfragen (nach `warmup` unmessenen) aus `clients` Threads.
+    make_request(client, rng) liefert die Antwort; alles außer 2xx zählt als Fehler.
+    """
+    for _ in range(warmup): make_request(client, rng)
+    seeds = [rng.random() for _ in range(clients)]
+    shares = [count // clients + (1 if slot < count % clients else 0) for slot in range(clients)]
+    latencies, errors = [], []
+
+    def worker(slot):
+        worker_rng = random.Random(seeds[slot]) # eigener Zufallsstrom je Thread, reproduzierbar
+        for _ in range(shares[slot]):
+            start = time.perf_counter()
+            try:
+                response = make_request(client, worker_rng)
+                failed = not 200 <= response.status_code < 300
+            except Exception:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            if failed: errors.append(1)
+
+    wall_start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(slot,)) for slot in range(clients)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return latency_summary(latencies, len(errors), time.perf_counter() - wall_start)
+
+
+def run_import_scenario(client, exports, imports):
+    """
+    Löst `imports` Updates über POST /update-database-auto aus und pollt bis zum
+    Ende des Jobs. Der Selenium-Download wird durch das Kopieren abwechselnder
+    synthetischer Exporte ersetzt, damit jeder Lauf ein echtes Delta schreibt.
+    """
+    original_download = app.download_shortage_list
+    next_export = itertools.cycle(exports)
+
+    def fake_download(log_messages=None):
+        if log_messages is None: log_messages = []
+        shutil.copyfile(next(next_export), app.DOWNLOAD_FILE_PATH)
+        log_messages.append("Download durch synthetischen Export ersetzt (Benchmark).")
+        return app.DOWNLOAD_FILE_PATH, log_messages
+
+    app.download_shortage_list = fake_download
+    latencies, errors, results = [], 0, []
+    wall_start = time.perf_counter()
+    try:
+        for _ in range(imports):
+            start = time.perf_counter()
+            job = client.post("/update-database-auto").get_json()
+            status_url = job["status_url"]
+            while job["status"] in ("queued", "running"):
+                time.sleep(0.01)
+                job = client.get(status_url).get_json()
+            latencies.append(time.perf_counter() - start)
+            if job["status"] != "success": errors += 1
+            results.append(job["result"])
+    finally:
+        app.download_shortage_list = original_download
+    summary = latency_summary(latencies, errors, time.perf_counter() - wall_start)
+    summary["results"] = results
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=app.BASE_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def bench_request_path(tmp_dir, args):
+    """
+    Treibt die Flask-App über ihren Test-Client: Autocomplete (Präfix und
+    fuzzy), Einzelprüfung ohne und mit Engpass (inkl. Alternativensuche und
+    CDS Hook an einen lokalen Stub), Batch-Prüfung und Excel-Import.
+    Rückgabe: Ergebnis-Dict (JSON-serialisierbar) für den Vergleich zwischen Commits.
+    """
+    db_path = os.path.join(tmp_dir, "requests.db")
+    names, atc_codes = create_synthetic_db(db_path, args.asp_rows, args.shortage_ratio, args.seed,
+                                           args.atc_group_size, args.atc_skew)
+    exports = [write_synthetic_basg_export(os.path.join(tmp_dir, f"export_{variant}.xlsx"), names, args.export_rows, args.seed + variant)
+               for variant in (1, 2)]
+    server, stub_url = start_cds_stub(args.cds_latency_ms)
+    saved = (app.DATABASE_PATH, app.EXTERNAL_CDS_HOOK_URL, app.DOWNLOAD_DIR, app.DOWNLOAD_FILE_PATH)
+    app.DATABASE_PATH, app.EXTERNAL_CDS_HOOK_URL = db_path, stub_url
+    app.DOWNLOAD_DIR = tmp_dir
+    app.DOWNLOAD_FILE_PATH = os.path.join(tmp_dir, app.EXPECTED_DOWNLOAD_FILENAME)
+    rng = random.Random(args.seed)
+    client = app.app.test_client()
+    scenarios = {}
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull): # Log-Ausgaben der App unterdrücken
+            index = app.refresh_drug_index()
+            active = sorted(index.active_shortage_names)
+            available = [name for name in names if name not in index.active_shortage_names]
+            run = lambda make_request: run_scenario(client, make_request, args.requests, args.warmup, args.clients, rng)
+            scenarios["autocomplete_prefix"] = run(lambda c, r: c.get("/autocomplete/medication", query_string={"term": r.choice(names)[:r.randint(3, 8)]}))
+            scenarios["autocomplete_fuzzy"] = run(lambda c, r: c.get("/autocomplete/medication", query_string={"term": typo_query(r.choice(names), r), "mode": "fuzzy"}))
+            scenarios["check_available"] = run(lambda c, r: c.post("/check-and-notify-external", json={"medication_name": r.choice(available)}))
+            if active: scenarios["check_shortage_alternatives"] = run(lambda c, r: c.post("/check-and-notify-external", json={"medication_name": r.choice(active)}))
+            scenarios["check_batch"] = run(lambda c, r: c.post("/check-batch", json={"medication_names": r.sample(names, min(args.request_batch_size, len(names)))}))
+            scenarios["excel_import"] = run_import_scenario(client, exports, args.imports)
+    finally:
+        server.shutdown()
+        app.DATABASE_PATH, app.EXTERNAL_CDS_HOOK_URL, app.DOWNLOAD_DIR, app.DOWNLOAD_FILE_PATH = saved
+    return {
+        "suite": "requests",
+        "git_commit": git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "config": {key: getattr(args, key) for key in ("asp_rows", "shortage_ratio", "atc_group_size", "atc_skew", "export_rows",
+                                                      "requests", "warmup", "clients", "imports", "request_batch_size", "cds_latency_ms", "seed")},
+        "dataset": {"asp_rows": len(names), "atc_codes": len(set(atc_codes)), "active_shortages": len(active)},
+        "cds_stub_requests": len(server.received),
+        "scenarios": scenarios
+    }
+
+
+def run_micro_benchmarks(tmp_dir, args):
+    """ Die Einzel-Benchmarks der Abfragepfade (Textausgabe). """
+    db_path = os.path.join(tmp_dir, "drug.db")
+    print(f"Erzeuge synthetische Datenbank mit {args.asp_rows} asp-Zeilen...")
+    names, atc_codes = create_synthetic_db(db_path, args.asp_rows, args.shortage_ratio, args.seed,
+                                           args.atc_group_size, args.atc_skew)
+    app.DATABASE_PATH = db_path
+    print("query plans (nach Schema-Migration)")
+    print_query_plans(db_path)
+    app.refresh_drug_index()
+    rng = random.Random(args.seed)
+    bench_find_alternatives(names, atc_codes, args.samples, rng)
+    bench_atc_levels(atc_codes, args.samples, rng)
+    bench_autocomplete(names, args.typed_names, rng)
+    bench_fuzzy(names, args.fuzzy_queries, rng)
+    bench_batch(names, args.batch_size, args.batches, rng)
+    print(f"import ({args.import_rows} Zeilen Engpass-Export)")
+    bench_import(db_path, names, args.import_rows, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks für ATC-AltFinder")
+    parser.add_argument("--asp-rows", type=int, default=50000)
+    parser.add_argument("--shortage-ratio", type=float, default=0.1)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--typed-names", type=int, default=30, help="Anzahl getippter Namen im Autocomplete-Trace")
+    parser.add_argument("--fuzzy-queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--import-rows", type=int, default=100000, help="Zeilen im synthetischen Engpass-Export")
+    parser.add_argument("--atc-group-size", type=int, default=40, help="Mittlere Anzahl Medikamente je ATC-Code")
+    parser.add_argument("--atc-skew", type=float, default=0.0, help="0 = gleich große ATC-Gruppen, > 0 = Zipf-verteilt")
+    parser.add_argument("--suite", choices=["micro", "requests", "all"], default="all",
+                        help="micro: einzelne Abfragepfade, requests: Flask-Anfragepfad mit JSON-Ergebnis")
+    parser.add_argument("--requests", type=int, default=500, help="Gemessene Anfragen je Szenario (Suite requests)")
+    parser.add_argument("--warmup", type=int, default=20, help="Ungemessene Anfragen vor jedem Szenario")
+    parser.add_argument("--clients", type=int, default=1, help="Parallele Client-Threads je Szenario")
+    parser.add_argument("--request-batch-size", type=int, default=100, help="Medikamente je /check-batch-Anfrage")
+    parser.add_argument("--export-rows", type=int, default=5000, help="Zeilen je synthetischem BASG-Export (Suite requests)")
+    parser.add_argument("--imports", type=int, default=4, help="Import-Läufe über /update-database-auto")
+    parser.add_argument("--cds-latency-ms", type=float, default=0.0, help="Künstliche Antwortzeit des CDS-Stubs")
+    parser.add_argument("--json", metavar="DATEI", help="Ergebnis der Suite requests als JSON hierhin schreiben (sonst stdout)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.suite in ("micro", "all"): run_micro_benchmarks(tmp_dir, args)
+        if args.suite in ("requests", "all"):
+            print(f"Anfragepfad ({args.requests} Anfragen je Szenario, {args.clients} Client(s))...")
+            report = bench_request_path(tmp_dir, args)
+            output = json.dumps(report, indent=2, ensure_ascii=False)
+            if args.json:
+                with open(args.json, "w", encoding="utf-8") as f: f.write(output + "\n")
+                print(f"Ergebnis geschrieben nach {args.json}")
+            else:
+                print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+# Gemeinsame Fixtures für die Tests: kleine synthetische drug.db statt der echten BASG-Daten
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+import benchmark
+
+
+@pytest.fixture
+def small_db(tmp_path):
+    """ Legt eine kleine drug.db im Ausgangsschema (vor allen Migrationen) an. Rückgabe: (Pfad, Namen). """
+    db_path = str(tmp_path / "drug.db")
+    names, _ = benchmark.create_synthetic_db(db_path, asp_rows=2000, shortage_ratio=0.2, seed=7)
+    return db_path, names
+
+
+@pytest.fixture
+def pooled_db(small_db, monkeypatch):
+    """
+    Stellt app.DATABASE_PATH auf die kleine Datenbank um und setzt den
+    Drug-Index zurück, damit kein Schnappschuss dieser Datenbank in spätere
+    Tests durchsickert. Schließt danach den Pool der Datenbank.
+    """
+    db_path, names = small_db
+    monkeypatch.setattr(app, "DATABASE_PATH", db_path)
+    monkeypatch.setattr(app, "_drug_index", None)
+    monkeypatch.setattr(app, "_drug_index_version", 0)
+    monkeypatch.setattr(app, "_drug_index_checked_at", 0.0)
+    yield db_path, names
+    pool = app._db_pools.pop(db_path, None)
+    if pool: pool.close()
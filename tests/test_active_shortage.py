@@ -0,0 +1,43 @@
+# Welche Meldungen ein Medikament als aktiven Engpass markieren
+import sqlite3
+
+import app
+
+
+def active_shortages(db_path, reports):
+    """ Ersetzt die Meldungen in shortage und baut active_shortage neu auf. Rückgabe: {Name: Status}. """
+    conn = sqlite3.connect(db_path)
+    app.migrate_database(conn)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM shortage")
+    cur.executemany("""INSERT INTO shortage (Name, Status, "Datum der Meldung", "Datum der letzten Änderung")
+                       VALUES (?, ?, ?, ?)""", reports)
+    app.fill_shortage_derived_columns(cur)
+    app.rebuild_active_shortage(cur)
+    conn.commit()
+    active = dict(conn.execute("SELECT Name, Status FROM active_shortage").fetchall())
+    conn.close()
+    return active
+
+
+def test_ended_report_does_not_cancel_open_report(small_db):
+    active = active_shortages(small_db[0], [
+        ("Ibuprofen", "Aktiv", "01.01.2025", "01.02.2025"),
+        ("Ibuprofen", "Beendet", "01.03.2025", "01.03.2025"),
+    ])
+    assert active == {"Ibuprofen": "Aktiv"}
+
+
+def test_same_date_reports_count_as_active_regardless_of_order(small_db):
+    for reports in [[("Ibuprofen", "Beendet", "01.01.2025", "01.02.2025"), ("Ibuprofen", "Aktiv", "01.01.2025", "01.02.2025")],
+                    [("Ibuprofen", "Aktiv", "01.01.2025", "01.02.2025"), ("Ibuprofen", "Beendet", "01.01.2025", "01.02.2025")]]:
+        assert active_shortages(small_db[0], reports) == {"Ibuprofen": "Aktiv"}
+
+
+def test_name_with_only_ended_reports_is_not_active(small_db):
+    active = active_shortages(small_db[0], [
+        ("Ibuprofen", "Beendet", "01.01.2025", "01.02.2025"),
+        ("Ibuprofen", "Beendet", "01.03.2025", "01.03.2025"),
+        ("Paracetamol", "Unbekannter Status", "01.03.2025", "01.03.2025"),
+    ])
+    assert active == {"Paracetamol": "Unbekannter Status"}
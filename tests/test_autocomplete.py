@@ -0,0 +1,18 @@
+# Präfixsuche des Autocomplete-Index
+import app
+
+NAMES = ["Ibuprofen Krka 5 mg Tropfen", "Ibuprofen 1A Pharma 10 mg Tropfen", "Ibuprofen", "Präparat X", "praparat y",
+         "Paracetamol Stada 500 mg Tabletten"]
+
+
+def test_exact_match_first_then_alphabetical():
+    index = app.AutocompleteIndex(NAMES)
+    assert index.search("ibuprofen") == ["Ibuprofen", "Ibuprofen 1A Pharma 10 mg Tropfen", "Ibuprofen Krka 5 mg Tropfen"]
+    assert index.search("IBU", limit=2) == ["Ibuprofen", "Ibuprofen 1A Pharma 10 mg Tropfen"]
+
+
+def test_case_and_diacritics_are_folded():
+    index = app.AutocompleteIndex(NAMES)
+    assert index.search("Prä") == ["Präparat X", "praparat y"]
+    assert index.search("xyz") == []
+    assert index.search("  ") == []
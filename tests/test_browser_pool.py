@@ -0,0 +1,116 @@
+# Warmer Browser: Wiederverwendung und Neustart nach Fehlern, mit einem Fake-WebDriver statt Chrome
+import pytest
+
+import app
+
+
+class FakeElement:
+    def __init__(self, on_click):
+        self.on_click = on_click
+
+    def is_displayed(self): return True
+    def is_enabled(self): return True
+    def click(self): self.on_click()
+
+
+class FakeDriver:
+    """ Beantwortet nur, was WarmBrowserPool und download_shortage_list brauchen. """
+    def __init__(self, on_click=lambda: None):
+        self.on_click = on_click
+        self.alive = True
+        self.quit_calls = 0
+
+    @property
+    def current_url(self):
+        if not self.alive: raise RuntimeError("Driver antwortet nicht")
+        return "about:blank"
+
+    def get(self, url): pass
+    def find_element(self, by, value): return FakeElement(self.on_click)
+    def save_screenshot(self, path): return True
+
+    def quit(self):
+        self.quit_calls += 1
+
+
+@pytest.fixture
+def fake_drivers(monkeypatch):
+    """ Ersetzt create_chrome_driver; Rückgabe: Liste aller gestarteten Fake-Driver. """
+    drivers = []
+    def create():
+        drivers.append(FakeDriver())
+        return drivers[-1]
+    monkeypatch.setattr(app, "create_chrome_driver", create)
+    return drivers
+
+
+def test_driver_is_reused_until_max_uses(fake_drivers):
+    pool = app.WarmBrowserPool(max_uses=2)
+    first = pool.acquire([]); pool.release([])
+    assert pool.acquire([]) is first
+    pool.release([])
+    assert first.quit_calls == 1
+    assert pool.acquire([]) is not first
+    pool.release([])
+    assert len(fake_drivers) == 2
+
+
+def test_driver_is_recycled_after_failure(fake_drivers):
+    pool = app.WarmBrowserPool(max_uses=10)
+    first = pool.acquire([]); pool.release([], failed=True)
+    assert first.quit_calls == 1
+    assert pool.acquire([]) is not first
+    pool.release([])
+
+
+def test_unresponsive_driver_is_replaced(fake_drivers):
+    pool = app.WarmBrowserPool(max_uses=10)
+    first = pool.acquire([]); pool.release([])
+    first.alive = False
+    assert pool.acquire([]) is not first
+    pool.release([])
+    assert first.quit_calls == 1
+
+
+@pytest.fixture
+def fake_download(monkeypatch, tmp_path):
+    """ download_shortage_list mit Fake-Driver und eigenem Pool in tmp_path. Rückgabe: (Pool, Driver-Liste). """
+    drivers = []
+    def create():
+        drivers.append(FakeDriver())
+        return drivers[-1]
+    pool = app.WarmBrowserPool(max_uses=10)
+    monkeypatch.setattr(app, "create_chrome_driver", create)
+    monkeypatch.setattr(app, "_browser_pool", pool)
+    monkeypatch.setattr(app, "WEBDRIVER_KEEP_WARM", True)
+    monkeypatch.setattr(app, "DOWNLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "DOWNLOAD_FILE_PATH", str(tmp_path / app.EXPECTED_DOWNLOAD_FILENAME))
+    return pool, drivers
+
+
+def test_download_timeout_recycles_browser(fake_download, monkeypatch):
+    pool, drivers = fake_download
+    monkeypatch.setattr(app, "wait_for_download", lambda *args: (False, 1.0, ["f.xlsx.crdownload"]))
+    path, _ = app.download_shortage_list([])
+    assert path is None
+    assert drivers[0].quit_calls == 1 and pool.driver is None
+
+
+def test_empty_download_recycles_browser(fake_download, monkeypatch):
+    pool, drivers = fake_download
+    open(app.DOWNLOAD_FILE_PATH, "wb").close()
+    monkeypatch.setattr(app, "wait_for_download", lambda *args: (False, 1.0, []))
+    path, _ = app.download_shortage_list([])
+    assert path is None
+    assert drivers[0].quit_calls == 1 and pool.driver is None
+
+
+def test_successful_download_keeps_browser_warm(fake_download, monkeypatch):
+    pool, drivers = fake_download
+    def write_export(*args):
+        with open(app.DOWNLOAD_FILE_PATH, "wb") as f: f.write(b"xlsx")
+        return True, 0.1, []
+    monkeypatch.setattr(app, "wait_for_download", write_export)
+    path, _ = app.download_shortage_list([])
+    assert path == app.DOWNLOAD_FILE_PATH
+    assert drivers[0].quit_calls == 0 and pool.driver is drivers[0]
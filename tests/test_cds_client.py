@@ -0,0 +1,115 @@
+# CDS-Hook-Client gegen einen lokalen Stub, der Fehler und Latenz einstreut
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app
+
+RESET_SECONDS = 0.3
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with stub["lock"]: stub["requests"] += 1
+        time.sleep(stub["delay"])
+        body = json.dumps({"cards": []}).encode()
+        self.send_response(stub["status"])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+
+@pytest.fixture
+def cds_stub():
+    """ Lokaler CDS-Service; Antwortstatus und Latenz lassen sich pro Test umstellen. """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.stub = {"status": 200, "delay": 0.0, "requests": 0, "lock": threading.Lock(),
+                   "url": f"http://127.0.0.1:{server.server_address[1]}/cds-services/EngpassMed"}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client():
+    client = app.CdsHookClient(pool_size=2, failure_threshold=3, reset_seconds=RESET_SECONDS)
+    yield client
+    client.executor.shutdown(wait=True)
+
+
+def payload():
+    return app.build_cds_hook_payload([("Ibuprofen", "M01AE01")])
+
+
+def open_breaker(client, cds_stub):
+    cds_stub["status"] = 500
+    for _ in range(client.failure_threshold):
+        assert client.send(payload(), cds_stub["url"])["status_code"] == 500
+
+
+def test_breaker_opens_after_threshold_and_rejects_calls(client, cds_stub):
+    open_breaker(client, cds_stub)
+    assert client.state() == "open"
+    result = client.send(payload(), cds_stub["url"])
+    assert "Circuit Breaker offen" in result["error"]
+    assert cds_stub["requests"] == client.failure_threshold # Abgelehnte Aufrufe erreichen den Service nicht
+
+
+def test_timeouts_count_as_failures(client, cds_stub, monkeypatch):
+    monkeypatch.setattr(app, "CDS_HOOK_TIMEOUT_SECONDS", 0.05)
+    cds_stub["delay"] = 0.2
+    for _ in range(client.failure_threshold):
+        assert client.send(payload(), cds_stub["url"])["error"] == "Timeout beim Senden des Hooks"
+    assert client.state() == "open"
+
+
+def test_single_half_open_trial_closes_breaker_on_success(client, cds_stub):
+    open_breaker(client, cds_stub)
+    time.sleep(RESET_SECONDS)
+    assert client.state() == "half-open"
+    cds_stub["status"], cds_stub["delay"] = 200, 0.3
+    trial_results = []
+    trial = threading.Thread(target=lambda: trial_results.append(client.send(payload(), cds_stub["url"])))
+    trial.start()
+    time.sleep(0.1) # Probeaufruf wartet jetzt auf den Stub
+    assert "Circuit Breaker offen" in client.send(payload(), cds_stub["url"])["error"]
+    trial.join()
+    assert trial_results[0]["status_code"] == 200
+    assert cds_stub["requests"] == client.failure_threshold + 1 # genau ein Probeaufruf
+    assert client.state() == "closed"
+    assert client.send(payload(), cds_stub["url"])["status_code"] == 200
+
+
+def test_failed_half_open_trial_reopens_breaker(client, cds_stub):
+    open_breaker(client, cds_stub)
+    time.sleep(RESET_SECONDS)
+    assert client.send(payload(), cds_stub["url"])["status_code"] == 500
+    assert client.state() == "open"
+
+
+def test_async_result_is_served_by_results_endpoint(client, cds_stub, monkeypatch):
+    monkeypatch.setattr(app, "cds_hook_client", client)
+    monkeypatch.setattr(app, "EXTERNAL_CDS_HOOK_URL", cds_stub["url"])
+    cds_stub["delay"] = 0.2
+    external_call = app.dispatch_cds_hook(payload(), async_hook=True)
+    assert external_call["status"] == "pending"
+    http = app.app.test_client()
+    assert http.get(external_call["result_url"]).status_code == 202
+    deadline = time.monotonic() + 5
+    while (response := http.get(external_call["result_url"])).status_code == 202 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert response.status_code == 200
+    assert response.json["status"] == "done" and response.json["status_code"] == 200
+    assert response.json["response_body"] == {"cards": []}
+    known, result = client.get_result(external_call["hook_instance"])
+    assert known and result["status_code"] == 200
+    assert http.get("/cds-hook-results/unbekannt").status_code == 404
@@ -0,0 +1,47 @@
+# Lesezugriffe über den Verbindungs-Pool, während ein Excel-Import schreibt
+import random
+import sqlite3
+import threading
+import time
+
+import app
+import benchmark
+
+READER_THREADS = 8
+IMPORT_ROWS = 5000
+
+
+def test_reads_during_import_do_not_fail(pooled_db, tmp_path):
+    db_path, names = pooled_db
+    excel_path = str(tmp_path / app.EXPECTED_DOWNLOAD_FILENAME)
+    benchmark.create_synthetic_shortage_frame(names, IMPORT_ROWS, seed=8).to_excel(excel_path, index=False)
+    app.migrate_with_write_db() # Nicht Teil des Imports, der gemessen wird
+    stop = threading.Event()
+    errors = []
+    read_times = []
+
+    def reader(slot):
+        rng = random.Random(slot)
+        while not stop.is_set():
+            name = rng.choice(names)
+            try:
+                conn = app.get_db()
+                for query, _ in app.LOOKUP_QUERIES.values():
+                    conn.execute(query, (name,) * query.count("?")).fetchall()
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+            read_times.append(time.perf_counter())
+            time.sleep(0.001) # Anfragen kommen verteilt, nicht in einer Endlosschleife
+
+    workers = [threading.Thread(target=reader, args=(slot,), daemon=True) for slot in range(READER_THREADS)]
+    for worker in workers: worker.start()
+    time.sleep(0.1)
+    import_start = time.perf_counter()
+    ok, logs, summary = app.update_database_from_excel(db_path, excel_path, [])
+    import_end = time.perf_counter()
+    stop.set()
+    for worker in workers: worker.join()
+
+    assert errors == []
+    assert ok and summary["result"] == "updated", logs[-3:]
+    assert any(import_start <= t <= import_end for t in read_times), "keine Lesezugriffe während des Imports"
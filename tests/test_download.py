@@ -0,0 +1,40 @@
+# Erkennen eines fertigen Downloads, gegen einen Fake, der die Datei wie Chrome schrittweise schreibt
+import os
+import threading
+import time
+
+import app
+
+FILENAME = "f.xlsx"
+
+
+def write_like_chrome(download_dir, chunks=5, pause=0.2, finish=True):
+    """ Hängt Blöcke an FILENAME.crdownload an und benennt die Datei zum Schluss (optional) um. """
+    partial_path = os.path.join(download_dir, FILENAME + ".crdownload")
+    for _ in range(chunks):
+        with open(partial_path, "ab") as f: f.write(b"x" * 4096)
+        time.sleep(pause)
+    if finish: os.rename(partial_path, os.path.join(download_dir, FILENAME))
+
+
+def test_returns_once_the_incremental_download_is_renamed(tmp_path):
+    writer = threading.Thread(target=write_like_chrome, args=(str(tmp_path),))
+    writer.start()
+    done, seconds, ongoing = app.wait_for_download(str(tmp_path), FILENAME, timeout_seconds=10, poll_interval=0.1, stable_checks=1)
+    writer.join()
+    assert (done, ongoing) == (True, [])
+    assert 1.0 <= seconds < 5 # nicht vor dem Umbenennen, aber lange vor dem Timeout
+    assert os.path.getsize(tmp_path / FILENAME) == 5 * 4096
+
+
+def test_unfinished_crdownload_times_out(tmp_path):
+    write_like_chrome(str(tmp_path), chunks=1, pause=0, finish=False)
+    done, seconds, ongoing = app.wait_for_download(str(tmp_path), FILENAME, timeout_seconds=0.5, poll_interval=0.1)
+    assert (done, ongoing) == (False, [FILENAME + ".crdownload"])
+    assert seconds >= 0.5
+
+
+def test_empty_file_is_not_complete(tmp_path):
+    (tmp_path / FILENAME).write_bytes(b"")
+    done, _, ongoing = app.wait_for_download(str(tmp_path), FILENAME, timeout_seconds=0.3, poll_interval=0.1)
+    assert (done, ongoing) == (False, [])
@@ -0,0 +1,51 @@
+# Neuaufbau des Drug-Index, wenn die asp-Tabelle außerhalb des Imports geändert wird
+import sqlite3
+
+import app
+import benchmark
+
+NEW_NAME = "Testpräparat 5 mg Tabletten"
+
+
+def edit_asp(db_path, statement, params=()):
+    """ Ändert asp über eine eigene Verbindung, wie ein manuelles Nachladen. """
+    conn = sqlite3.connect(db_path)
+    conn.execute(statement, params)
+    conn.commit()
+    conn.close()
+
+
+def test_index_picks_up_manual_asp_changes(pooled_db, monkeypatch):
+    db_path, names = pooled_db
+    monkeypatch.setattr(app, "DRUG_INDEX_STALE_CHECK_SECONDS", 0)
+    first = app.get_drug_index()
+    assert app.get_drug_index() is first # unverändert: kein Neuaufbau
+    edit_asp(db_path, "INSERT INTO asp (Name, ATC_Code, Zulassungsnummer) VALUES (?, 'N02BE01', '1-1')", (NEW_NAME,))
+    index = app.get_drug_index()
+    assert index.version == first.version + 1
+    assert NEW_NAME in index.details_by_name
+    assert [name for name, _ in index.fuzzy_index.search("Testpraparat")] == [NEW_NAME]
+    edit_asp(db_path, "UPDATE asp SET ATC_Code = 'A01AA01' WHERE Name = ?", (NEW_NAME,)) # gleiche Zeilenzahl
+    assert app.get_drug_index().details_by_name[NEW_NAME]["ATC_Code"] == "A01AA01"
+
+
+def test_check_interval_bounds_the_checks(pooled_db, monkeypatch):
+    db_path, _ = pooled_db
+    monkeypatch.setattr(app, "DRUG_INDEX_STALE_CHECK_SECONDS", 3600)
+    first = app.get_drug_index()
+    edit_asp(db_path, "INSERT INTO asp (Name) VALUES (?)", (NEW_NAME,))
+    assert app.get_drug_index() is first
+
+
+def test_unchanged_import_picks_up_asp_changes(pooled_db, monkeypatch, tmp_path):
+    db_path, names = pooled_db
+    monkeypatch.setattr(app, "DRUG_INDEX_STALE_CHECK_SECONDS", 3600)
+    excel_path = str(tmp_path / app.EXPECTED_DOWNLOAD_FILENAME)
+    benchmark.create_synthetic_shortage_frame(names, 200, seed=8).to_excel(excel_path, index=False)
+    app.update_database_from_excel(db_path, excel_path, [])
+    first = app.get_drug_index()
+    edit_asp(db_path, "INSERT INTO asp (Name) VALUES (?)", (NEW_NAME,))
+    ok, _, summary = app.update_database_from_excel(db_path, excel_path, [])
+    assert ok and summary["result"] == "unchanged"
+    assert NEW_NAME in app.get_drug_index().details_by_name
+    assert app.get_drug_index().version == first.version + 1
@@ -0,0 +1,38 @@
+# Trigramm-Index für die unscharfe Namenssuche
+import app
+
+NAMES = ["Ibuprofen Genericon 400 mg Filmtabletten", "Ibuprofen ratiopharm 200 mg Brausetabletten",
+         "Paracetamol Stada 500 mg Tabletten", "Diclofenac Sandoz 50 mg Zäpfchen"]
+
+
+def names(results):
+    return [name for name, _ in results]
+
+
+def test_misspelling_and_word_order():
+    index = app.FuzzyNameIndex(NAMES)
+    assert names(index.search("Ibuprofn"))[:2] == NAMES[:2]
+    assert names(index.search("ratiopharm ibu")) == [NAMES[1]]
+
+
+def test_two_character_fragment_inside_a_word():
+    index = app.FuzzyNameIndex(NAMES)
+    assert names(index.search("bu")) == NAMES[:2]
+    assert index.search("qq") == []
+
+
+def test_unknown_trigrams_skip_the_linear_scan():
+    index = app.FuzzyNameIndex(NAMES)
+    index.keys = None # Ein Scan über die Namen würde hier fehlschlagen
+    assert index.search("xyz") == []
+    assert index.search("zzzz") == []
+
+
+def test_dropped_trigrams_fall_back_to_substring_scan(monkeypatch):
+    monkeypatch.setattr(app, "FUZZY_MAX_POSTINGS", 40)
+    index = app.FuzzyNameIndex(NAMES)
+    assert index.total_postings <= 40 and " mg" in index.dropped_trigrams
+    assert set(names(index.search("mg"))) == set(NAMES)
+    monkeypatch.setattr(app, "FUZZY_MAX_POSTINGS", 0)
+    index = app.FuzzyNameIndex(NAMES)
+    assert names(index.search("ibuprofen")) == NAMES[:2]
@@ -0,0 +1,48 @@
+# Schema-Migrationen und Abfragepläne der Nachschlage-Abfragen
+import sqlite3
+
+import app
+
+
+def table_names(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_migrations_bring_schema_to_current_version(small_db):
+    conn = sqlite3.connect(small_db[0])
+    assert app.migrate_database(conn) == [version for version, _, _ in app.SCHEMA_MIGRATIONS]
+    assert app.get_schema_version(conn) == app.SCHEMA_VERSION
+    assert {"active_shortage", "shortage_changelog", "shortage_import_state"} <= table_names(conn)
+    assert conn.execute("SELECT COUNT(*) FROM shortage WHERE status_normalized IS NULL").fetchone()[0] == 0
+    conn.close()
+
+
+def test_migrations_are_idempotent(small_db):
+    conn = sqlite3.connect(small_db[0])
+    app.migrate_database(conn)
+    schema = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+    assert app.migrate_database(conn) == []
+    assert app.get_schema_version(conn) == app.SCHEMA_VERSION
+    assert conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    conn.close()
+
+
+def test_migrations_accept_tables_created_before_versioning(small_db):
+    # Ältere Datenbanken haben Changelog und Fingerabdrücke schon beim Import angelegt
+    conn = sqlite3.connect(small_db[0])
+    app.migrate_database(conn)
+    conn.execute("INSERT INTO shortage_import_state VALUES ('file_sha256', 'abc', '2025-01-01')")
+    conn.execute("PRAGMA user_version = 3")
+    conn.commit()
+    assert app.migrate_database(conn) == [version for version, _, _ in app.SCHEMA_MIGRATIONS if version > 3]
+    assert conn.execute("SELECT value FROM shortage_import_state").fetchall() == [("abc",)]
+    conn.close()
+
+
+def test_lookup_queries_use_indexes(small_db):
+    conn = sqlite3.connect(small_db[0])
+    app.migrate_database(conn)
+    for label, (query, params) in app.LOOKUP_QUERIES.items():
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+        assert any(step.startswith("SEARCH") for step in plan), f"{label}: {plan}"
+    conn.close()